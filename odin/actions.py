@@ -1,11 +1,25 @@
 import logging
+
+import numpy as np
 from progress.bar import ChargingBar
 
 import odin
 from odin import plot as oplt
 from odin.models import load_model
 from odin.compute import default_interface as co
-from odin.compute import lambda_param, compress, architecture
+from odin.compute import lambda_param, compress, architecture, covariance, parallel, low_rank_approximation
+from odin.compute.activation_store import ActivationStore, sample_indices, split_inputs, split_size
+
+
+def _activation_store(model_wrapper, use_training_data=True, **kwargs):
+    """
+    The activation store for the samples chosen by --batch_size and --seed, or the whole split with --streaming,
+    like in calc_eigs.
+    """
+    data_size = split_size(model_wrapper, use_training_data)
+    batch_size = None if kwargs.get("streaming") else kwargs.get("batch_size", 100)
+    indices = sample_indices(data_size, batch_size, seed=kwargs.get("seed"))
+    return ActivationStore(model_wrapper, indices, use_training_data=use_training_data)
 
 
 def test_lambda_optimizer(**kwargs):
@@ -20,7 +34,7 @@ def test_lambda_optimizer(**kwargs):
     cov = datastore["cov"]
     eigen_values = datastore["eigen_values"]
 
-    l_opt = lambda_param.LambdaOptimizer(model_wrapper)
+    l_opt = lambda_param.LambdaOptimizer(model_wrapper, spectrum_tol=kwargs.get("spectrum_tol"))
 
     w_opt = compress.CovarianceOptimizer(model_wrapper)
 
@@ -47,15 +61,60 @@ def calc_index_set(**kwargs):
     :return:
     """
     model_wrapper = load_model(kwargs.get("model"), **kwargs)
+    layer_widths, cov_list = _index_set_inputs(model_wrapper, **kwargs)
+
+    architecture.calculate_index_set(model_wrapper=model_wrapper, layer_widths=layer_widths,
+                                     cov_list=cov_list, method=kwargs.get("index_set_method") or "incremental",
+                                     parallel=kwargs.get("parallel"), greedy_mode=kwargs.get("greedy_mode") or "plain",
+                                     concurrent_layers=kwargs.get("concurrent_layers"),
+                                     resume=not kwargs.get("no_index_set_log"))
+
+
+def compare_index_sets(**kwargs):
+    """
+    Compare the quality and the time of the index set methods for every layer.
+
+    Dependency: range_test
+
+    :param kwargs:
+    :return:
+    """
+    model_wrapper = load_model(kwargs.get("model"), **kwargs)
+    layer_widths, cov_list = _index_set_inputs(model_wrapper, **kwargs)
 
+    methods = ["incremental", "pivoted_cholesky", "qr"]
+    if kwargs.get("index_set_method") and kwargs["index_set_method"] not in methods:
+        methods.append(kwargs["index_set_method"])
+
+    reports = []
+    for l, (layer, m_l, cov) in enumerate(zip(model_wrapper.layers(), layer_widths, cov_list)):
+        if not architecture.is_selectable(layer, cov):
+            continue
+        report = architecture.compare_index_set_methods(cov, m_l, methods=methods)
+        print("Layer %d (%d of %d nodes)" % (l, m_l, cov.shape[0]))
+        for method, quality, elapsed_time in report:
+            print("  %-16s quality = %.5f  time = %.3fs" % (method, quality, elapsed_time))
+        reports.append(report)
+
+    return reports
+
+
+def _index_set_inputs(model_wrapper, **kwargs):
+    """
+    The layer widths chosen from range_test and the covariance matrices used by the index set selection.
+    """
     method = "Newton-CG"
     r_dof = model_wrapper.get_group("range_test")
     # bounds = r_dof["rho_range"]
     layer_widths_list = r_dof["all_layer_widths"]
     # lambdas = r_dof["all_lambdas"]
 
-    data = model_wrapper.get_group("inter_layer_covariance")
-    cov_list = data["cov"]
+    if kwargs.get("activation_cache"):
+        cov_list = _activation_store(model_wrapper, **kwargs).layer_covariances(
+            **covariance.accumulator_options_for(model_wrapper, **kwargs))
+    else:
+        data = model_wrapper.get_group("inter_layer_covariance")
+        cov_list = data["cov"]
     # eigen_values = data["eigen_values"]
 
     loss_before = []
@@ -66,8 +125,7 @@ def calc_index_set(**kwargs):
     logging.info("Finding the new architecture for %s" % layer_widths)
     print("Finding the new architecture for %s" % layer_widths)
 
-    architecture.calculate_index_set(model_wrapper=model_wrapper, layer_widths=layer_widths,
-                                     cov_list=cov_list)
+    return layer_widths, cov_list
 
 
 def create_compressed_network(**kwargs):
@@ -84,10 +142,95 @@ def create_compressed_network(**kwargs):
     data = model_wrapper.get_group("inter_layer_covariance")
     cov_list = data["cov"]
     model = architecture.transfer_to_architecture(model_wrapper=model_wrapper,
-                                                  cov_list=cov_list)
+                                                  cov_list=cov_list, reconstruct=not kwargs.get("no_reconstruction"),
+                                                  mean_list=data.get("mean"))
     model.save()
 
 
+def narrow_network(**kwargs):
+    """
+    Remove the neurons CovarianceOptimizer does not select from the layers and save the smaller model with the prefix
+    '_narrow'. Prints the parameter count and per batch inference latency before and after.
+    Dependency: calc_eigs
+
+    :param kwargs:
+    :return: the compression report
+    """
+    model_wrapper = load_model(kwargs.get("model"), **kwargs)
+
+    optimizer = compress.CovarianceOptimizer(model_wrapper)
+    _, narrowed = optimizer.compress(alpha=kwargs.get("compress_alpha", 0.01),
+                                     method=kwargs.get("compress_method", "greedy"), narrow=True,
+                                     criterion=kwargs.get("selection_criterion", "trace"))
+    narrowed.save()
+
+    report = compress.compression_report(model_wrapper, narrowed, _test_batch(model_wrapper, **kwargs))
+    _print_compression_report(report)
+    narrowed.put_group("compression_report", report)
+
+    return report
+
+
+def factorize_network(**kwargs):
+    """
+    Replace the kernels of the fully connected layers by low rank factors from a randomized SVD at --rank or --energy
+    and save the factorized model with the prefix '_factorized'. Layers where the factors would not save FLOPs are kept.
+    Only keras models, where a kernel has the shape (inputs, units), can be factorized.
+    Prints the FLOPs, parameter count and per batch inference latency before and after.
+
+    :param kwargs:
+    :return: the compression report
+    """
+    model_wrapper = load_model(kwargs.get("model"), **kwargs)
+    if model_wrapper.model_type != "keras":
+        raise ValueError("factorize_network only supports keras models, %s is a %s model"
+                         % (model_wrapper.model_name, model_wrapper.model_type))
+
+    factors = {}
+    flops_before = flops_after = 0
+    for layer in model_wrapper.layers():
+        if layer.type != "fully_connected":
+            continue
+        inputs, units = layer.weights.shape
+        p, q = low_rank_approximation.factorize(layer.weights, rank=kwargs.get("rank"),
+                                                energy=kwargs.get("energy", 0.99), seed=kwargs.get("seed"))
+        rank = p.shape[1]
+        flops_before += low_rank_approximation.dense_flops(inputs, units)
+        if low_rank_approximation.is_worth_factorizing(inputs, units, rank):
+            logging.info("Factorizing %s (%d, %d) with rank %d" % (layer.original.name, inputs, units, rank))
+            factors[layer.original.name] = (p, q)
+            flops_after += low_rank_approximation.dense_flops(inputs, units, rank)
+        else:
+            flops_after += low_rank_approximation.dense_flops(inputs, units)
+
+    factorized = model_wrapper.factorized(factors)
+    factorized.save()
+
+    report = compress.compression_report(model_wrapper, factorized, _test_batch(model_wrapper, **kwargs))
+    report["flops_before"] = flops_before
+    report["flops_after"] = flops_after
+    _print_compression_report(report)
+    factorized.put_group("compression_report", report)
+
+    return report
+
+
+def _test_batch(model_wrapper, **kwargs):
+    """
+    The test inputs chosen by --batch_size and --seed.
+    """
+    data_size = split_size(model_wrapper, use_training_data=False)
+    indices = sample_indices(data_size, kwargs.get("batch_size", 100), seed=kwargs.get("seed"))
+    return split_inputs(model_wrapper, indices, use_training_data=False)
+
+
+def _print_compression_report(report):
+    columns = ["parameters", "latency"] + (["flops"] if "flops_before" in report else [])
+    print("%10s" % "" + "".join("%14s" % c for c in columns))
+    for stage in ("before", "after"):
+        print("%10s" % stage + "".join("%14g" % report["%s_%s" % (c, stage)] for c in columns))
+
+
 def measure_goodness(**kwargs):
     """
     [WIP]
@@ -107,6 +250,16 @@ def measure_goodness(**kwargs):
 
     print(loss_original, loss_compressed)
 
+    if kwargs.get("activation_cache"):
+        # Compare the outputs with the cached outputs of the original model
+        store = _activation_store(original_model, use_training_data=False, **kwargs)
+        original_outputs = store.load()[-1]
+        (_, _), (x_test, _) = compressed_model.load_dataset()
+        compressed_outputs = compressed_model.get_layer_outputs(x_test[store.indices])[-1]
+        agreement = np.mean(np.argmax(original_outputs, axis=-1) == np.argmax(compressed_outputs, axis=-1))
+        mse = np.mean(np.square(original_outputs - compressed_outputs))
+        print("Output agreement with the original model: %.5f (mse=%.5f)" % (agreement, mse))
+
     # Fine tune
     print("Fine tuning")
     compressed_model.train()
@@ -130,11 +283,15 @@ def calc_dof(**kwargs):
     """
     model_wrapper = load_model(kwargs.get("model"), **kwargs)
 
-    l_opt = lambda_param.LambdaOptimizer(model_wrapper)
+    l_opt = lambda_param.LambdaOptimizer(model_wrapper, spectrum_tol=kwargs.get("spectrum_tol"))
 
     method = "Newton-CG"
-    line = co.xp.linspace(5.0, 100.0, num=100)
-    lambdas, layer_widths, success = l_opt.range_lambda_dof(line, method=method)
+    line = co.xp.linspace(5.0, 100.0, num=kwargs.get("num") or 100)
+    if kwargs.get("lambda_method") == "batch":
+        lambdas, layer_widths, success = l_opt.optimize_batch(line)
+    else:
+        line, lambdas, layer_widths, success = l_opt.lambda_path(line, method=method,
+                                                                 refine=kwargs.get("refine", False))
     co.store_elements(model_wrapper=model_wrapper, experiment=kwargs.get("experiment"),
                       elements={"lambdas": lambdas, "bounds": line, "layer_widths": layer_widths, "success": success},
                       group_name="range_dof_%s" % method)
@@ -173,27 +330,53 @@ def range_test(**kwargs):
     """
     model_wrapper = load_model(kwargs.get("model"), **kwargs)
 
-    l_opt = lambda_param.LambdaOptimizer(model_wrapper)
+    l_opt = lambda_param.LambdaOptimizer(model_wrapper, spectrum_tol=kwargs.get("spectrum_tol"))
 
-    method = "Newton-CG"
+    method = kwargs.get("lambda_method") or "Newton-CG"
     num = kwargs.get("num") or 1000
     max_rho = kwargs.get("max") or 0.15
 
     regularizing = kwargs.get("regularizing")
 
     rho_range = co.xp.linspace(0.01, max_rho, num=num)
-    all_lambdas = []
-    all_layer_widths = []
-    bar = ChargingBar("Testing a range of rho on LambdaOptimizer", max=num)
-    for rho in rho_range:
-        lambdas, layer_widths = l_opt.optimize(rho=rho, method=method, debug=kwargs.get('verbose'),
-                                               regularizing=regularizing)
-        if kwargs['verbose']:
+
+    if method == "batch":
+        if regularizing == "abs":
+            logging.warning("The batch solver only supports the 'sq' regularizer")
+        all_lambdas, all_layer_widths, _ = l_opt.optimize_batch(rho_range)
+        print("Solved %d values of rho with %d batched Newton iterations" % (len(rho_range), l_opt.batch_iterations))
+    elif kwargs.get("parallel"):
+        all_lambdas = []
+        all_layer_widths = []
+        store_every = max(1, num // 20)
+        bar = ChargingBar("Testing a range of rho on LambdaOptimizer", max=num)
+
+        def store_partial(i, lambdas, layer_widths, success):
+            all_lambdas.append(lambdas)
+            all_layer_widths.append(layer_widths)
+            if (i + 1) % store_every == 0:
+                # rho_range is written last so that a partial result never has more rho values than widths
+                co.store_elements(model_wrapper=model_wrapper, group_name="range_test",
+                                  experiment=kwargs.get("experiment"),
+                                  elements={"all_lambdas": all_lambdas, "all_layer_widths": all_layer_widths})
+                co.store_elements(model_wrapper=model_wrapper, group_name="range_test",
+                                  experiment=kwargs.get("experiment"), elements={"rho_range": rho_range[:i + 1]})
+            bar.next()
+
+        num_workers = kwargs.get("available_cores") or odin.config.get("available_cores", 4)
+        parallel.sweep_rho(l_opt, rho_range, num_workers, method=method, callback=store_partial,
+                           regularizing=regularizing)
+        bar.finish()
+    else:
+        rho_range, all_lambdas, all_layer_widths, _ = l_opt.lambda_path(rho_range, method=method,
+                                                                        refine=kwargs.get("refine", False),
+                                                                        debug=kwargs.get('verbose'),
+                                                                        regularizing=regularizing)
+        print("Solved %d values of rho with %d optimizer iterations" % (len(rho_range), l_opt.path_iterations))
+
+    if kwargs.get('verbose'):
+        for rho, lambdas, layer_widths in zip(rho_range, all_lambdas, all_layer_widths):
             print("rho=", rho, layer_widths, lambdas)
-        all_lambdas.append(lambdas)
-        all_layer_widths.append(layer_widths)
-        bar.next()
-    bar.finish()
 
     co.store_elements(model_wrapper=model_wrapper, group_name="range_test", experiment=kwargs.get("experiment"),
                       elements={"rho_range": rho_range, "all_lambdas": all_lambdas,
@@ -212,9 +395,11 @@ def range_test_plot(**kwargs):
     """
     model_wrapper = load_model(kwargs.get("model"), **kwargs)
     data = model_wrapper.get_group("range_test", experiment=kwargs.get("experiment"))
+    # A sweep that is still running may have stored fewer values of rho than results
+    n = len(data["rho_range"])
     rho_range = data["rho_range"]
-    all_lambdas = data["all_lambdas"]
-    all_layer_widths = data["all_layer_widths"]
+    all_lambdas = data["all_lambdas"][:n]
+    all_layer_widths = data["all_layer_widths"][:n]
 
     n_layers = len(all_lambdas)
 
@@ -262,6 +447,35 @@ def calc_eigs(**kwargs):
     return cov, eigen_values
 
 
+def benchmark_covariance(**kwargs):
+    """
+    Compare the per sample outer product loop with the batched covariance engine for a range of layer widths.
+    No model is needed.
+
+    :param kwargs:
+    :return:
+    """
+    num_samples = kwargs.get("batch_size") or 100
+    widths = (100, 250, 500, 1000, 2000)
+    results = covariance.benchmark(widths=widths, num_samples=num_samples)
+
+    print("%8s %12s %12s %10s" % ("width", "loop (s)", "gemm (s)", "speedup"))
+    for width, loop_time, gemm_time, speedup in results:
+        print("%8d %12.5f %12.5f %9.1fx" % (width, loop_time, gemm_time, speedup))
+
+    if kwargs.get("plot"):
+        widths, loop_times, gemm_times, _ = zip(*results)
+        oplt.figure()
+        oplt.loglog(widths, loop_times, label="outer product loop")
+        oplt.loglog(widths, gemm_times, label="$X^TX$")
+        oplt.labels("layer width", "time (s)")
+        oplt.legend()
+        oplt.save("benchmark_covariance")
+        oplt.show()
+
+    return results
+
+
 def train_model(**kwargs):
     """
     Train the specified model. Commandline arguments will be passed to the training function.
@@ -332,13 +546,17 @@ action_map = {
     "plot_dof": plot_dof,
     "calc_dof": calc_dof,
     "calc_eigs": calc_eigs,
+    "benchmark_covariance": benchmark_covariance,
     "train_model": train_model,
     "test_model": test_model,
     "measure_goodness": measure_goodness,
     "update_architecture": calc_index_set,
     "up_arch": calc_index_set,
     "calc_index_set": calc_index_set,
+    "compare_index_sets": compare_index_sets,
     "create_compressed_network": create_compressed_network,
     "compress": create_compressed_network,
+    "narrow_network": narrow_network,
+    "factorize_network": factorize_network,
     "": test_lambda_optimizer
 }
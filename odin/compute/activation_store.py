@@ -0,0 +1,172 @@
+"""
+The activation store persists the outputs of every wrapped layer for a fixed set of samples so that the forward pass
+is paid once per model version and not once per action.
+"""
+import hashlib
+import logging
+import os
+from glob import glob
+
+import numpy as np
+from progress.bar import ChargingBar
+
+import odin
+from .covariance import make_accumulator
+
+
+def weights_hash(model_wrapper):
+    """
+    Hash the current weights of a model.
+    :param model_wrapper:
+    :return: hex digest
+    """
+    h = hashlib.sha1()
+    for w in model_wrapper.weights():
+        w = getattr(w, "data", w)  # chainer variables
+        h.update(np.ascontiguousarray(w).tobytes())
+    return h.hexdigest()
+
+
+def split_size(model_wrapper, use_training_data=True):
+    """
+    The number of samples in a dataset split of the model.
+    """
+    train, test = model_wrapper.dataset
+    data = train if use_training_data else test
+    if model_wrapper.model_type == "chainer":
+        return len(data)
+    return len(data[0])
+
+
+def split_inputs(model_wrapper, indices, use_training_data=True):
+    """
+    Stack the inputs of the given samples of a dataset split.
+    """
+    train, test = model_wrapper.dataset
+    data = train if use_training_data else test
+    if model_wrapper.model_type == "chainer":
+        return np.stack([data[i][0] for i in indices], axis=0)
+    return np.asarray(data[0])[indices]
+
+
+def sample_indices(data_size, batch_size=None, seed=None):
+    """
+    Choose a reproducible sorted subset of sample indices.
+    :param data_size: The size of the dataset split
+    :param batch_size: The number of samples. All samples are used if it is not positive.
+    :param seed: Seed for the permutation
+    :return: array of indices
+    """
+    if not batch_size or batch_size <= 0 or batch_size >= data_size:
+        return np.arange(data_size)
+    return np.sort(np.random.RandomState(seed).permutation(data_size)[0:batch_size])
+
+
+class ActivationStore(object):
+    """
+    Layer outputs for a chosen set of samples stored as memory mapped .npy files in
+    '<model_path>/activations/<key>/layer_<l>.npy'.
+    The key is derived from the model weights, the dataset split and the sample indices, so a retrained model or a
+    different sample set never reads stale activations.
+    """
+    group_name = "activations"
+    _complete_file = "complete"
+
+    def __init__(self, model_wrapper, indices, use_training_data=True, compute_batch_size=100):
+        """
+        :param model_wrapper:
+        :param indices: The indices of the samples in the dataset split
+        :param use_training_data: Use the training split, otherwise the test split
+        :param compute_batch_size: Batch size of the forward passes when the store is written
+        """
+        self.model_wrapper = model_wrapper
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.use_training_data = use_training_data
+        self.compute_batch_size = compute_batch_size
+
+        h = hashlib.sha1(weights_hash(model_wrapper).encode())
+        h.update(b"train" if use_training_data else b"test")
+        h.update(self.indices.tobytes())
+        self.key = h.hexdigest()[:16]
+        self.path = os.path.join(model_wrapper.model_path, self.group_name, self.key)
+
+    def __len__(self):
+        return len(self.indices)
+
+    @property
+    def complete(self):
+        return os.path.isfile(os.path.join(self.path, self._complete_file))
+
+    def layer_file(self, layer):
+        return os.path.join(self.path, "layer_%d.npy" % layer)
+
+    def write(self):
+        """
+        Run the forward passes and write the layer outputs to disk.
+        :return: self
+        """
+        odin.check_or_create_dir(self.path)
+        n = len(self.indices)
+        is_chainer = self.model_wrapper.model_type == "chainer"
+
+        outputs = None
+        bar = ChargingBar("Storing layer activations", max=n)
+        for start in range(0, n, self.compute_batch_size):
+            indices = self.indices[start:start + self.compute_batch_size]
+            layer_outputs = self.model_wrapper.get_layer_outputs(
+                split_inputs(self.model_wrapper, indices, self.use_training_data))
+            if is_chainer:
+                layer_outputs = [out.data for out in layer_outputs]
+            # Move cupy arrays to the host
+            layer_outputs = [out.get() if hasattr(out, "get") else out for out in layer_outputs]
+
+            if outputs is None:
+                outputs = [np.lib.format.open_memmap(self.layer_file(l), mode="w+", dtype=out.dtype,
+                                                     shape=(n,) + tuple(out.shape[1:]))
+                           for l, out in enumerate(layer_outputs)]
+
+            for memmap, out in zip(outputs, layer_outputs):
+                memmap[start:start + len(indices)] = out
+            bar.next(len(indices))
+        bar.finish()
+
+        for memmap in outputs:
+            memmap.flush()
+        np.save(os.path.join(self.path, "indices.npy"), self.indices)
+        open(os.path.join(self.path, self._complete_file), "w").close()
+
+        logging.info("Stored activations of %d layers for %d samples in '%s'" % (len(outputs), n, self.path))
+        return self
+
+    def load(self):
+        """
+        Memory map the stored layer outputs, writing them first if necessary.
+        :return: list of read only arrays of shape (samples, ...) per layer
+        """
+        if not self.complete:
+            self.write()
+        num_layers = len(glob(os.path.join(self.path, "layer_*.npy")))
+        return [np.load(self.layer_file(l), mmap_mode="r") for l in range(num_layers)]
+
+    def batches(self, batch_size=100):
+        """
+        Yield the layer outputs in the same format as ModelWrapper.get_layer_outputs.
+        """
+        layers = self.load()
+        for start in range(0, len(self), batch_size):
+            yield [np.asarray(layer[start:start + batch_size]) for layer in layers]
+
+    def layer_covariances(self, batch_size=100, **accumulator_options):
+        """
+        Accumulate the covariance of every layer from the stored activations.
+        :param batch_size:
+        :param accumulator_options: Passed to odin.compute.covariance.make_accumulator, see accumulator_options_for
+        :return: list of covariance matrices
+        """
+        accumulators = None
+        for layer_outputs in self.batches(batch_size):
+            if accumulators is None:
+                accumulators = [make_accumulator(layer_out, **accumulator_options) for layer_out in layer_outputs]
+            for accumulator, layer_out in zip(accumulators, layer_outputs):
+                accumulator.update(layer_out)
+        return [accumulator.covariance() for accumulator in accumulators]
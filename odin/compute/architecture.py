@@ -1,71 +1,411 @@
 """
 Architecture contains functions to compute a new subset of nodes after compression.
 """
+import hashlib
+import heapq
 import multiprocessing
+import os
 import time
 
 import numpy as np
 import numpy.linalg as LA
+import scipy.linalg as SLA
 import logging
 from progress.bar import ChargingBar
 import odin
 import odin.plot as oplt
 from odin.compute import default_interface as co
+from odin.compute.parallel import IndexSetPool
 
 
 def pickle_fix(arg):
     """
     Makes nested functions picklable
     """
-    return pickle_fix.calc(arg)
+    selected, node = arg
+    return pickle_fix.calc(np.union1d(selected, node))
 
 
-def greedy(constraint, indexes, m_l, parallel=False):
+class IndexSetLog(object):
+    """
+    Append only log of the greedy steps of one layer. The first line identifies the covariance matrix and the method,
+    every following line holds a selected node and its score. A log of a different covariance or method is started
+    over, and an incomplete last line from an interrupted write is ignored.
+    """
+
+    def __init__(self, path, cov, method):
+        """
+        :param path: The log file
+        :param cov: The covariance matrix of the layer
+        :param method: Identifies the selection method
+        """
+        self.path = path
+        self.signature = "%s %s" % (method, hashlib.sha1(np.ascontiguousarray(cov).tobytes()).hexdigest())
+        self.selected = []
+        self.scores = []
+
+        content = ""
+        if os.path.isfile(path):
+            with open(path) as f:
+                content = f.read()
+        # Every complete line ends with a newline, so anything after the last one is incomplete
+        complete = content[:content.rfind("\n") + 1]
+        lines = complete.split("\n")[:-1]
+
+        if lines and lines[0] == self.signature:
+            for line in lines[1:]:
+                node, score = line.split()
+                self.selected.append(int(node))
+                self.scores.append(float(score))
+            os.truncate(path, len(complete.encode()))
+            self._file = open(path, "a")
+            logging.info("Resuming the index set selection in '%s' after %d steps" % (path, len(self.selected)))
+        else:
+            odin.check_or_create_dir(os.path.dirname(path))
+            self._file = open(path, "w")
+            self._file.write(self.signature + "\n")
+            self._file.flush()
+
+    def __len__(self):
+        return len(self.selected)
+
+    def append(self, node, score):
+        self.selected.append(int(node))
+        self.scores.append(float(score))
+        self._file.write("%d %r\n" % (node, float(score)))
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+greedy_modes = ["plain", "lazy", "stochastic"]
+
+
+def greedy(constraint, indexes, m_l, parallel=False, pool=None, mode="plain", epsilon=0.1, seed=None, log=None):
     """
     Greedy selection of nodes
+
+    In 'lazy' mode the marginal gains are kept in a max heap and only the top candidate is re-evaluated until it stays
+    on top, which selects the same nodes as 'plain' when the objective is submodular. In 'stochastic' mode every step
+    only scores a random subset of (d / m_l) log(1 / epsilon) remaining candidates. The number of objective evaluations
+    and the number plain greedy would have used are stored in greedy.evaluations.
+
+    :param constraint: The objective of a set of nodes, which is maximized
+    :param indexes: The candidate nodes
+    :param m_l: The number of nodes to select
+    :param parallel: Evaluate the candidates on a pool of 'available_cores' forked processes which is kept for all steps
+    :param pool: An odin.compute.parallel.IndexSetPool scoring the candidates instead of constraint
+    :param mode: One of greedy_modes
+    :param epsilon: The accuracy of the stochastic mode
+    :param seed: Seed of the stochastic mode
+    :param log: An IndexSetLog. The selection continues after its steps and appends the new ones.
     """
+    if mode not in greedy_modes:
+        raise ValueError("Unknown greedy mode %s" % mode)
 
     selected = np.array([])
     plot = False
     choices = np.array(indexes)
-    bar = ChargingBar("Calculating index set with greedy method", max=m_l)
+    if log is not None and len(log) > 0:
+        selected = np.union1d(selected, log.selected)
+        choices = np.setdiff1d(choices, log.selected)
+    resumed_steps = len(selected)
+    bar = ChargingBar("Calculating index set with %s greedy method" % mode, max=m_l)
+    bar.next(resumed_steps)
+
+    local_pool = None
+    if parallel and pool is None:
+        # Forked workers inherit the constraint so that closures work
+        pickle_fix.calc = constraint
+        available_cores = odin.config.get("available_cores", 4)
+        local_pool = multiprocessing.get_context("fork").Pool(processes=available_cores)
+
+    evaluations = [0]
+
+    def evaluate(nodes):
+        evaluations[0] += len(nodes)
+        if pool is not None:
+            return pool.scores(selected, nodes)
+        elif local_pool is not None:
+            chunksize = max(1, len(nodes) // (4 * available_cores))
+            return local_pool.map(pickle_fix, [(selected, node) for node in nodes], chunksize=chunksize)
+        else:
+            # values: [float]
+            return [constraint(np.union1d(selected, node)) for node in nodes]
+
+    rng = np.random.RandomState(seed)
+    sample_size = int(np.ceil(len(choices) / max(m_l, 1) * np.log(1 / epsilon)))
+    heap = []
+    current_value = log.scores[-1] if log is not None and len(log) > 0 else 0.0
+
+    try:
+        for i in range(len(selected), m_l):
+            # print("i = %d" % i)
+            start = time.time()
+
+            if mode == "lazy":
+                if not heap:
+                    # (-gain, node, step of the evaluation)
+                    heap = [(current_value - value, node, i) for node, value in zip(choices, evaluate(choices))]
+                    heapq.heapify(heap)
+                while heap[0][2] != i:
+                    _, node, _ = heapq.heappop(heap)
+                    value = evaluate([node])[0]
+                    heapq.heappush(heap, (current_value - value, node, i))
+                gain, greedy_choice, _ = heapq.heappop(heap)
+                current_value -= gain
+                values = None
+                score = current_value
+            else:
+                if mode == "stochastic" and sample_size < len(choices):
+                    candidates = np.sort(rng.choice(choices, sample_size, replace=False))
+                else:
+                    candidates = choices
+                values = evaluate(candidates)
+                greedy_choice = candidates[np.argmax(values)]
+                score = np.max(values)
+
+            if log is not None:
+                log.append(greedy_choice, score)
+
+            if plot and values is not None:
+                values = np.sort(values)
+                oplt.plot(values)
+                oplt.show()
+                # current_best = np.max(values)
+
+            selected = np.union1d(selected, [greedy_choice])
+            choices = np.setdiff1d(choices, [greedy_choice])
+            logging.debug("selected = %s; choice = %s; time = %.5f" % (
+                selected, greedy_choice, time.time() - start))
+            bar.next()
+    finally:
+        if local_pool is not None:
+            local_pool.close()
+            local_pool.join()
+    bar.finish()
 
-    for i in range(len(selected), m_l):
-        # print("i = %d" % i)
-        start = time.time()
+    d = len(indexes)
+    plain_evaluations = sum(d - i for i in range(resumed_steps, m_l))
+    greedy.evaluations = (evaluations[0], plain_evaluations)
+    if mode != "plain":
+        logging.info("%s greedy used %d objective evaluations, %d fewer than plain greedy" % (
+            mode.capitalize(), evaluations[0], plain_evaluations - evaluations[0]))
 
-        def calc(node):
-            return constraint(np.union1d(selected, node))
+    return selected
 
-        if parallel:
-            pickle_fix.calc = calc
-            available_cores = odin.config.get("available_cores", 4)
-            pool = multiprocessing.Pool(processes=available_cores)
-            values = pool.map(pickle_fix, choices)
-            pool.close()
-        else:
-            # values: [float]
-            values = list(map(calc, choices))
 
-        greedy_choice = choices[np.argmax(values)]
+def index_set_objective(cov, j, theta=0.5):
+    """
+    The fraction tr(ch cov_fj pinv(cov_jj) cov_jf) / tr(ch cov_ff) of the remaining nodes f explained by the nodes j.
+    """
+    j = list(map(int, j))
+    f = np.setdiff1d(np.arange(cov.shape[0]), j)
+    n = len(f)
+    tr = np.trace
+    sig_inv = LA.pinv(cov[np.ix_(j, j)])
+
+    I = np.eye(n)
+    R_z = np.eye(n)  # Projection matrix
+    ch = theta * I + (1 - theta) * R_z
 
-        if plot:
-            values = np.sort(values)
-            oplt.plot(values)
-            oplt.show()
-            # current_best = np.max(values)
+    difference = tr(ch.dot(cov[np.ix_(f, j)]).dot(sig_inv).dot(cov[np.ix_(j, f)]))
+    normalizer = tr(ch.dot(cov[np.ix_(f, f)]))
+    return difference / normalizer
 
-        selected = np.union1d(selected, [greedy_choice])
-        choices = np.setdiff1d(choices, [greedy_choice])
-        logging.debug("selected = %s; choice = %s; time = %.5f" % (
-            selected, greedy_choice, time.time() - start))
+
+class SchurComplement(object):
+    """
+    The Schur complement R = cov - cov_:S cov_SS^-1 cov_S: of a growing set S of selected nodes, kept up to date with a
+    rank one update per node, together with the squared column norms |R_:c|^2. Adding c explains |R_:c|^2 / R_cc more
+    of tr(cov), so all candidates are scored with a single pass over R.
+    """
+
+    def __init__(self, cov, rtol=1e-10):
+        """
+        :param cov: The covariance matrix of the layer
+        :param rtol: Diagonals of R below rtol * max(diag(cov)) are treated as zero
+        """
+        self.residual = np.array(cov, dtype=np.float64)
+        diagonal = np.diag(self.residual)
+        self.eps = rtol * max(np.max(np.abs(diagonal)), np.finfo(float).tiny)
+        self.column_norms = np.einsum("ij,ij->j", self.residual, self.residual)
+
+    def add_block(self, j, cov):
+        """
+        Add the nodes j at once with a pseudo inverse of cov_jj.
+        :return: the explained trace tr(cov_:j pinv(cov_jj) cov_j:)
+        """
+        explained = cov[:, j].dot(LA.pinv(cov[np.ix_(j, j)])).dot(cov[j, :])
+        self.residual -= explained
+        self.column_norms = np.einsum("ij,ij->j", self.residual, self.residual)
+        return np.trace(explained)
+
+    def gains(self):
+        """
+        :return: |R_:c|^2 / R_cc for every node, zero for the nodes linearly dependent on S, and the independent mask
+        """
+        residual_diagonal = np.diag(self.residual)
+        independent = residual_diagonal > self.eps
+        gain = np.zeros(len(residual_diagonal))
+        gain[independent] = self.column_norms[independent] / residual_diagonal[independent]
+        return gain, independent
+
+    def add(self, c):
+        """
+        Add node c with a rank one update. Nodes that are linearly dependent on S leave R unchanged.
+        """
+        if self.residual[c, c] <= self.eps:
+            return
+        r = self.residual[:, c] / np.sqrt(self.residual[c, c])
+        # |R_:c - r r_c|^2 expanded, with R r computed before the update
+        self.column_norms += r ** 2 * r.dot(r) - 2 * r * self.residual.dot(r)
+        self.residual -= np.outer(r, r)
+
+
+def incremental_greedy(cov, m_l, rtol=1e-10, log=None):
+    """
+    Greedy selection maximizing tr(cov_fj pinv(cov_jj) cov_jf) / tr(cov_ff), where f is the complement of j.
+
+    The Schur complement R of the selected set is kept up to date in a SchurComplement. Since
+    tr(cov_:j cov_jj^-1 cov_j:) grows by the gain of a node when it is added, every remaining candidate is scored with
+    a single pass over R, which is O(d^2) per step instead of a pseudo inverse per candidate.
+    Candidates that are linearly dependent on the selected set add nothing, like in the pseudo inverse.
+
+    :param cov: The covariance matrix of the layer
+    :param m_l: The number of nodes to select
+    :param rtol: Schur complement diagonals below rtol * max(diag(cov)) are treated as zero
+    :param log: An IndexSetLog. The selection continues after its steps and appends the new ones.
+    :return: the selected indexes in increasing order
+    """
+    d = cov.shape[0]
+    schur = SchurComplement(cov, rtol)
+    diagonal = np.diag(schur.residual).copy()
+    total_trace = np.sum(diagonal)
+
+    projected_trace = 0.0  # tr(cov_:j cov_jj^-1 cov_j:)
+    selected_trace = 0.0  # tr(cov_jj)
+    remaining = np.ones(d, dtype=bool)
+    selected = list(log.selected) if log is not None else []
+    if selected:
+        # The Schur complement of the logged steps in one block
+        j = np.array(selected)
+        projected_trace = schur.add_block(j, cov)
+        selected_trace = np.sum(diagonal[j])
+        remaining[j] = False
+
+    bar = ChargingBar("Calculating index set with incremental greedy method", max=m_l)
+    bar.next(len(selected))
+
+    for i in range(len(selected), m_l):
+        gain, independent = schur.gains()
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            values = (projected_trace + gain - selected_trace - diagonal) / (total_trace - selected_trace - diagonal)
+        candidates = np.flatnonzero(remaining)
+        choice = candidates[np.argmax(values[candidates])] if len(candidates) > 1 else candidates[0]
+
+        if independent[choice]:
+            schur.add(choice)
+            projected_trace += gain[choice]
+        selected_trace += diagonal[choice]
+        remaining[choice] = False
+        selected.append(choice)
+        if log is not None:
+            log.append(choice, values[choice])
+        logging.debug("choice = %d; score = %.5f" % (choice, values[choice]))
         bar.next()
     bar.finish()
 
-    return selected
+    return np.sort(np.array(selected, dtype=int))
+
+
+def pivoted_cholesky(cov, m_l=None, tol=None):
+    """
+    Partial pivoted Cholesky factorization cov ~ L L^T. Every step pivots on the largest diagonal of the Schur
+    complement, i.e. the node with the most variance left unexplained by the selected nodes. Only the m_l computed
+    columns of L are kept, so it is O(d m_l^2).
+
+    :param cov: The covariance matrix of the layer
+    :param m_l: The maximal number of pivots. All nodes by default.
+    :param tol: Stop when the trace of the Schur complement is at most tol
+    :return: the pivots in the order they were chosen and the trace of the Schur complement after each of them
+    """
+    d = cov.shape[0]
+    m = d if m_l is None else m_l
+    factor = np.zeros((d, m))
+    residual_diagonal = np.diag(cov).astype(np.float64)
+    remaining = np.ones(d, dtype=bool)
+    pivots = []
+    residual_traces = []
+
+    for k in range(m):
+        c = int(np.argmax(np.where(remaining, residual_diagonal, -np.inf)))
+        pivot = residual_diagonal[c]
+        if pivot > 0:
+            column = (cov[:, c] - factor[:, :k].dot(factor[c, :k])) / np.sqrt(pivot)
+            factor[:, k] = column
+            residual_diagonal -= column ** 2
+        remaining[c] = False
+        residual_diagonal[c] = 0
+        pivots.append(c)
+        residual_traces.append(np.sum(np.maximum(residual_diagonal[remaining], 0)))
+        if tol is not None and residual_traces[-1] <= tol:
+            break
+
+    return np.array(pivots, dtype=int), np.array(residual_traces)
+
+
+def column_pivoted_qr(cov, m_l):
+    """
+    The first m_l column pivots of a rank revealing QR factorization of cov.
+    """
+    _, pivots = SLA.qr(cov, mode="r", pivoting=True)
+    return pivots[:m_l]
+
+
+def index_set_quality(cov, j):
+    """
+    The difference / normalizer residual of the greedy objective for the nodes j, computed without the dense projection
+    matrices since R_z is the identity. Higher is better.
+    """
+    j = np.asarray(j, dtype=int)
+    f = np.setdiff1d(np.arange(cov.shape[0]), j)
+    cov_fj = cov[np.ix_(f, j)]
+    difference = np.sum(cov_fj * cov_fj.dot(LA.pinv(cov[np.ix_(j, j)])))
+    normalizer = np.sum(np.diag(cov)[f])
+    return difference / normalizer
 
 
-def compute_index_set(layer, cov, m_l, shape, weights, using_jl=False):
+def compare_index_set_methods(cov, m_l, methods=("incremental", "pivoted_cholesky", "qr")):
+    """
+    Select m_l nodes with each method and report the quality and the time.
+    :return: a list of (method, quality, seconds)
+    """
+    report = []
+    for method in methods:
+        start_time = time.time()
+        j = compute_index_set(None, cov, m_l, cov.shape[0], None, method=method)
+        elapsed_time = time.time() - start_time
+        report.append((method, index_set_quality(cov, j), elapsed_time))
+    return report
+
+
+index_set_methods = ["incremental", "greedy", "pivoted_cholesky", "qr"]
+
+
+def compute_index_set(layer, cov, m_l, shape, weights, using_jl=False, method="incremental", pool=None,
+                      greedy_mode="plain", log=None):
+    """
+    Select m_l nodes of a layer.
+    :param method: 'incremental' for the Schur complement greedy or 'greedy' to evaluate the objective with a pseudo
+        inverse for every candidate. Both select the same nodes. 'pivoted_cholesky' and 'qr' are single pass
+        approximations of the greedy selection, see index_set_quality to compare them.
+    :param pool: An odin.compute.parallel.IndexSetPool evaluating the candidates of the 'greedy' method
+    :param greedy_mode: The mode of the 'greedy' method, see greedy
+    :param log: An IndexSetLog of the greedy methods. A log with at least m_l steps gives the index set directly.
+    """
     if using_jl:
         # Somehow broken
         print("Enter Julia")
@@ -77,93 +417,214 @@ def compute_index_set(layer, cov, m_l, shape, weights, using_jl=False):
         print("Exit julia")
         return j
 
-    indexes = np.arange(shape)
+    if log is not None and len(log) >= m_l and method in ("incremental", "greedy"):
+        # The greedy steps do not depend on m_l
+        return np.sort(np.array(log.selected[:m_l], dtype=int))
 
-    tr = np.trace
-    theta = 0.5
-    W = weights
+    if method == "incremental":
+        # The projection R_z is the identity, so the objective only depends on cov
+        return incremental_greedy(cov, m_l, log=log)
+    elif method == "pivoted_cholesky":
+        return np.sort(pivoted_cholesky(cov, m_l)[0])
+    elif method == "qr":
+        return np.sort(column_pivoted_qr(cov, m_l))
+    elif method != "greedy":
+        raise ValueError("Unknown index set method %s" % method)
+
+    indexes = np.arange(shape)
 
     # R_z = W.T.dot(np.linalg.pinv(W.dot(W.T))).dot(W)
 
     def obj(j):
-        j = list(map(int, j))
-        f = np.setdiff1d(indexes, j)
-        n = len(f)
-        sig_inv = LA.pinv(cov[np.ix_(j, j)])
-
-        I = np.eye(n)
-        R_z = np.eye(n)  # Projection matrix
-        ch = theta * I + (1 - theta) * R_z
-
-        difference = tr(ch.dot(cov[np.ix_(f, j)]).dot(sig_inv).dot(cov[np.ix_(j, f)]))
-        normalizer = tr(ch.dot(cov[np.ix_(f, f)]))
-        return difference / normalizer
+        return index_set_objective(cov, j)
 
-    j = greedy(obj, indexes, m_l, parallel=False)
+    if pool is not None:
+        pool.set_covariance(cov)
+    j = greedy(obj, indexes, m_l, parallel=False, pool=pool, mode=greedy_mode, log=log)
 
     j = j.astype(dtype=int)
 
     return j
 
 
-def calculate_index_set(model_wrapper, layer_widths, cov_list):
+def is_selectable(layer, cov):
+    """
+    Nodes can be selected in fully connected layers and in convolutional layers with a channel wise covariance.
+    """
+    if layer.type == "fully_connected":
+        return True
+    return layer.type in ("convolution", "convolution_2d") and cov.shape[0] == layer.units
+
+
+def _open_log(log_path, cov, method, greedy_mode):
+    if log_path is None or method not in ("incremental", "greedy"):
+        return None
+    return IndexSetLog(log_path, cov, method if method == "incremental" else "%s-%s" % (method, greedy_mode))
+
+
+def _layer_index_set(task):
+    l, cov, m_l, method, greedy_mode, log_path = task
+    start_time = time.time()
+    log = _open_log(log_path, cov, method, greedy_mode)
+    try:
+        j = compute_index_set(l, cov, m_l, cov.shape[0], None, using_jl=False, method=method,
+                              greedy_mode=greedy_mode, log=log)
+    finally:
+        if log is not None:
+            log.close()
+    return l, j, log.scores if log is not None else None, time.time() - start_time
+
+
+def calculate_index_set(model_wrapper, layer_widths, cov_list, method="incremental", parallel=False,
+                        greedy_mode="plain", concurrent_layers=False, resume=True):
+    """
+    Compute and store the index set of every selectable layer.
+    :param method: See compute_index_set
+    :param parallel: Evaluate the candidates of the 'greedy' method on one pool of 'available_cores' processes which
+        is shared by all layers
+    :param greedy_mode: The mode of the 'greedy' method, see greedy
+    :param concurrent_layers: Compute the layers on a pool of 'available_cores' processes, largest layer first. Each
+        index set is stored as soon as it is done.
+    :param resume: Log every greedy step in 'index_set/layer_<l>.log' and continue from an existing log of the same
+        covariance and method. The scores of the steps are stored as 'layer_<l>_scores'.
+    """
     layers = model_wrapper.layers()
     index_set = []
+
+    tasks = []
     for l, (layer, m_l, cov) in enumerate(zip(layers, layer_widths, cov_list)):
-        if layer.type == "fully_connected":
+        if is_selectable(layer, cov):
+            log_path = os.path.join(model_wrapper.model_path, "index_set", "layer_%d.log" % l) if resume else None
+            tasks.append((l, cov, m_l, method, greedy_mode, log_path))
+
+    def store(l, j, scores, elapsed_time):
+        assert len(j) == layer_widths[l]
+
+        elements = {"layer_%d" % l: j}
+        if scores is not None:
+            elements["layer_%d_scores" % l] = np.array(scores)
+        model_wrapper.put_group(group="index_set", elements=elements)
+
+        logging.info("Computed index set for layer %d in %f with quality %.5f" % (
+            l, elapsed_time, index_set_quality(cov_list[l], j)))
+
+    if concurrent_layers and len(tasks) > 1:
+        if parallel:
+            logging.warning("The candidates are evaluated serially when the layers are computed concurrently")
+        # The largest layers are dispatched first so that they do not end up last on a busy pool
+        tasks.sort(key=lambda task: (task[1].shape[0], task[2]), reverse=True)
+        num_workers = min(len(tasks), odin.config.get("available_cores", 4))
+        logging.info("Will Compute index sets for layers %s on %d processes" % ([task[0] for task in tasks],
+                                                                                 num_workers))
+        with multiprocessing.get_context("spawn").Pool(processes=num_workers) as layer_pool:
+            for result in layer_pool.imap_unordered(_layer_index_set, tasks):
+                store(*result)
+        return index_set
+
+    pool = IndexSetPool() if parallel and method == "greedy" else None
+    try:
+        for l, cov, m_l, _, _, log_path in tasks:
             shape = cov.shape[0]  # layer.out_size
             start_time = time.time()
             logging.info("Will Compute index set for layer %d up to size %d" % (l, m_l))
-            j = compute_index_set(l, cov, m_l, shape, layer.weights, using_jl=False)
+            log = _open_log(log_path, cov, method, greedy_mode)
+            try:
+                j = compute_index_set(l, cov, m_l, shape, layers[l].weights, using_jl=False, method=method,
+                                      pool=pool, greedy_mode=greedy_mode, log=log)
+            finally:
+                if log is not None:
+                    log.close()
+
+            store(l, j, log.scores if log is not None else None, time.time() - start_time)
+    finally:
+        if pool is not None:
+            pool.close()
+
+    return index_set
+
 
-            assert len(j) == m_l
+def reconstruction_matrix(cov, j, regularizer=1e-3):
+    """
+    The least squares reconstruction of the removed nodes f from the kept nodes j, h_f ~ A h_j. The ridge regularized
+    system (cov_jj + r I) A^T = cov_jf is solved with a Cholesky factorization.
 
-            model_wrapper.put_group(group="index_set", elements={"layer_%d" % l: j})
+    :param cov: The covariance matrix of the layer outputs
+    :param j: The kept nodes
+    :param regularizer: r relative to the mean variance tr(cov_jj) / |j|
+    :return: the removed nodes f and A^T with shape (|j|, |f|)
+    """
+    j = np.asarray(j, dtype=int)
+    f = np.setdiff1d(np.arange(cov.shape[0]), j)
+    cov_jj = cov[np.ix_(j, j)]
+    ridge = regularizer * np.trace(cov_jj) / max(len(j), 1)
+    factor = SLA.cho_factor(cov_jj + ridge * np.eye(len(j)))
+    return f, SLA.cho_solve(factor, cov[np.ix_(j, f)])
 
-            elapsed_time = time.time() - start_time
-            logging.info("Computed index set for layer %d in %f" % (l, elapsed_time))
 
-    return index_set
+def transfer_to_architecture(model_wrapper, cov_list, reconstruct=True, regularizer_w=1e-3, mean_list=None):
+    """
+    Create the compressed model keeping the nodes of the stored index sets.
 
+    With reconstruct the removed outputs of each layer are replaced by their linear reconstruction from the kept ones,
+    which is folded into the weights of the next layer: h W = h_j W_j + h_f W_f ~ h_j (W_j + A^T W_f).
+    If cov_list holds mean centered covariances, the reconstruction h_f ~ mu_f + A (h_j - mu_j) also has an intercept,
+    which is folded into the bias of the next layer: (mu_f - A mu_j) W_f.
 
-def transfer_to_architecture(model_wrapper, cov_list):
-    regularizer_w = 1
+    :param reconstruct: Fold the reconstruction of the removed nodes into the next layer
+    :param regularizer_w: The ridge regularizer of the reconstruction, see reconstruction_matrix
+    :param mean_list: The means of the layer outputs when cov_list is mean centered
+    """
     layers = model_wrapper.layers()
     weights = []
     biases = []
     index_sets = model_wrapper.get_group(group="index_set")
     layer_widths = []
     last_j = None
+    last_f = None
+    last_conversion = None
+    last_intercept = None
+
+    def incoming_weights(w, columns):
+        if last_j is None:
+            return w[:, columns]
+        sub_weights = w[np.ix_(last_j, columns)]
+        if last_conversion is not None:
+            sub_weights = sub_weights + last_conversion.dot(w[np.ix_(last_f, columns)])
+        return sub_weights
+
+    def incoming_biases(layer, columns):
+        if last_intercept is None:
+            return None if layer.biases is None else layer.biases[columns]
+        shift = last_intercept.dot(layer.weights[np.ix_(last_f, columns)])
+        if layer.biases is None:
+            logging.warning("The reconstruction intercept of the removed nodes is dropped since the layer has no bias")
+            return None
+        return layer.biases[columns] + shift
 
     for l, (layer, cov) in enumerate(zip(layers[0:-1], cov_list)):  # skip the last layer
         if layer.type == "fully_connected":
-            shape = layer.units
-            indexes = np.arange(shape)
-
-            j = index_sets["layer_%d" % l]
+            j = np.asarray(index_sets["layer_%d" % l], dtype=int)
             m_l = len(j)
             layer_widths.append(m_l)
 
-            f = np.setdiff1d(indexes, j)
-
-            _I_w = np.eye(m_l) * regularizer_w
-            conversion_matrix = cov[np.ix_(f, j)].dot(LA.inv(cov[np.ix_(j, j)] + _I_w))
-            if last_j is not None:
-                sub_weights = layer.weights[np.ix_(last_j, j)]
-            else:
-                sub_weights = layer.weights[:, j]
-
-            new_weights = sub_weights  # conversion_matrix.dot()
-            weights.append(new_weights)
-            if layer.biases:
-                biases.append(layer.biases[j])
+            weights.append(incoming_weights(layer.weights, j))
+            layer_biases = incoming_biases(layer, j)
+            if layer_biases is not None:
+                biases.append(layer_biases)
 
+            if reconstruct:
+                last_f, last_conversion = reconstruction_matrix(cov, j, regularizer_w)
+                if mean_list is not None:
+                    mean = np.asarray(mean_list[l])
+                    last_intercept = mean[last_f] - mean[j].dot(last_conversion)
             last_j = j
 
     last_layer = layers[-1]
-    sub_weights = last_layer.weights[last_j, :]
-    new_weights = sub_weights  # conversion_matrix.dot()
-    weights.append(new_weights)
+    columns = np.arange(last_layer.weights.shape[1])
+    weights.append(incoming_weights(last_layer.weights, columns))
+    last_biases = incoming_biases(last_layer, columns)
+    if last_biases is not None:
+        biases.append(last_biases)
 
     new_wrapper = model_wrapper.__class__(layer_widths=layer_widths, weights=weights, biases=biases,
                                           prefix=(model_wrapper.prefix + "_compressed"), new_model=True)
@@ -34,7 +34,7 @@ class ComputationInterface(object):
         :param experiment: An extra label
         :return:
         """
-        path = os.path.join(model_wrapper.model_path, group_name, "*.npy")
+        path = os.path.join(model_wrapper.model_path, group_name)
         if experiment:
             path = os.path.join(path, experiment)
         path = os.path.join(path, "*.npy")
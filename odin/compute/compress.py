@@ -1,9 +1,20 @@
 # from keras.models import Model
 import logging
+import time
 
 import numpy as np
+import numpy.linalg as LA
+import scipy.linalg as SLA
 
-accepted_layers = ['Dense', 'Conv2D', 'Conv1D']
+from .architecture import SchurComplement, is_selectable, pivoted_cholesky
+
+accepted_layers = ['Dense', 'Conv2D', 'Conv1D', 'Linear', 'Convolution2D']
+
+_kernel_layers = ['Dense', 'Conv1D', 'Conv2D', 'Conv3D']
+_channel_layers = ['BatchNormalization']
+_passthrough_layers = ['InputLayer', 'Dropout', 'Activation', 'ReLU', 'LeakyReLU',
+                       'MaxPooling1D', 'MaxPooling2D', 'AveragePooling1D', 'AveragePooling2D',
+                       'GlobalMaxPooling1D', 'GlobalMaxPooling2D', 'GlobalAveragePooling1D', 'GlobalAveragePooling2D']
 
 
 def generalization_error(lambs, n):
@@ -24,70 +35,203 @@ class CovarianceOptimizer:
         self.covariance_matrices = model_wrapper.get_element("inter_layer_covariance", "cov")
         self.__dict__.update(**kwargs)
 
-    def compress(self, alpha=0.01, method="greedy"):
+    def compress(self, alpha=0.01, method="greedy", narrow=False, criterion="trace"):
+        """
+        Select the neurons of each accepted layer from its inter layer covariance. The output layer is kept.
+        :param alpha: The variance the removed neurons may leave unexplained
+        :param method: 'greedy', 'pivoted_cholesky' or 'group_sparse'
+        :param narrow: Also build a model wrapper where the removed neurons are sliced away
+        :param criterion: The selection criterion of the greedy method
+        :return: the selections per layer, and the narrowed model wrapper if narrow
+        """
         result = []
+        keep = {}
 
-        for n, layer in enumerate(self.model_wrapper.layers()):
-            logging.info("Compressing layer %d - %s" % (n, str(layer.__class__)))
-            if layer.__class__.__name__ not in accepted_layers:
+        for n, layer in enumerate(self.model_wrapper.layers()[:-1]):  # skip the output layer
+            logging.info("Compressing layer %d - %s" % (n, str(layer.original.__class__)))
+            if layer.original.__class__.__name__ not in accepted_layers:
                 logging.info("Skipping...")
                 continue
-            weights, biases = layer.get_weights()
             sigma = self.covariance_matrices[n]
+            if not is_selectable(layer, sigma):
+                logging.info("Skipping the covariance of shape %s, which is not channel wise. "
+                             "Use --conv_reduction channel to compress convolutional layers." % str(sigma.shape))
+                continue
             if method == "greedy":
-                neurons, excluded = _greedy(sigma, alpha)
-                result.append((neurons, excluded))
-
-                # logging.info('Theoretical %f and compressed size %d/%d' %
-                #             (self.theoretical_widths[n], len(neurons), len(neurons) + len(excluded)))
-                logging.debug('Compressed layer %s' % str(neurons))
-
-                weights[:, excluded] = 0
-                biases[excluded] = 0
-
-                # weights = weights[:, neurons]
-                # biases = biases[neurons]
-                # TODO W=A*W
-                # adapted_layer = Dense(len(neurons))
-                # layer.output_shape = len(neurons)
-                # layer.set_weights([weights, biases])
-
-                # compute_eigen_values(sigma, plot=True)
+                neurons, excluded = _greedy(sigma, alpha, criterion=criterion)
+            elif method == "pivoted_cholesky":
+                neurons, excluded = _pivoted_cholesky(sigma, alpha)
             else:
-                A = _group_sparse(sigma)
-
-                adjusted_weights = A.dot(weights)
-
-            return result
-
-
-def _greedy(cov, alpha):
-    constraint = []
+                neurons, excluded = _group_sparse_selection(sigma, alpha)
+            result.append((neurons, excluded))
+
+            # logging.info('Theoretical %f and compressed size %d/%d' %
+            #             (self.theoretical_widths[n], len(neurons), len(neurons) + len(excluded)))
+            logging.debug('Compressed layer %s' % str(neurons))
+            keep[layer.original.name] = neurons
+
+            # compute_eigen_values(sigma, plot=True)
+
+        if narrow:
+            return result, self.model_wrapper.narrowed(keep)
+        return result
+
+
+def narrow_weights(layers, keep):
+    """
+    Slice the weights of a chain of layers, in the keras layout, so that only the kept units of the compressed
+    layers remain. The removed units are also removed from the inputs of the layers downstream.
+
+    :param layers: list of (class name, weights, input shape) in the order of the chain
+    :param keep: dict from the position of a compressed layer in the chain to the indexes of its kept units
+    :return: list of the sliced weights of every layer
+    """
+    inputs = None
+    sliced = []
+    for n, (name, weights, input_shape) in enumerate(layers):
+        weights = list(weights)
+        if name in _kernel_layers:
+            if inputs is not None:
+                weights[0] = weights[0][..., inputs, :]
+            inputs = None
+            if n in keep:
+                inputs = np.asarray(keep[n])
+                weights[0] = weights[0][..., inputs]
+                if len(weights) > 1:
+                    weights[1] = weights[1][inputs]
+        elif inputs is None or name in _passthrough_layers:
+            pass
+        elif name in _channel_layers:
+            weights = [w[inputs] for w in weights]
+        elif name == "Flatten":
+            spatial = int(np.prod(input_shape[1:-1]))
+            inputs = (np.arange(spatial)[:, None] * input_shape[-1] + inputs[None, :]).ravel()
+        else:
+            raise ValueError("Can not remove units from the input of layer %d (%s)" % (n, name))
+        sliced.append(weights)
+
+    return sliced
+
+
+def inference_latency(model_wrapper, x, repeat=10):
+    """
+    The median time of model_wrapper.predict_batch(x) after one warm up call.
+    """
+    model_wrapper.predict_batch(x)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        model_wrapper.predict_batch(x)
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+def compression_report(original, compressed, x, repeat=10):
+    """
+    Measure the parameter count and per batch inference latency of a model before and after compression.
+    :param original: model wrapper
+    :param compressed: model wrapper
+    :param x: input batch
+    :param repeat: The number of timed batches
+    :return: dict
+    """
+    report = {
+        "parameters_before": original.parameter_count(),
+        "parameters_after": compressed.parameter_count(),
+        "latency_before": inference_latency(original, x, repeat),
+        "latency_after": inference_latency(compressed, x, repeat),
+    }
+    logging.info("Compression report %s" % report)
+    return report
+
+
+class _Selection(object):
+    """
+    Running state of a greedy neuron selection. With track_residual the Schur complement R of the selected set is kept
+    in an architecture.SchurComplement.
+    """
+
+    def __init__(self, cov, alpha, track_residual=False, rtol=1e-10):
+        self.cov = np.asarray(cov, dtype=np.float64)
+        self.alpha = alpha
+        self.diagonal = np.diag(self.cov).copy()
+        self.total_trace = np.sum(self.diagonal)
+        self.selected_trace = 0.0
+        self.remaining = np.ones(len(self.diagonal), dtype=bool)
+        self.order = []
+        self.schur = SchurComplement(self.cov, rtol) if track_residual else None
+        self.leverage = None
+
+    def add(self, j):
+        if self.schur is not None:
+            self.schur.add(j)
+        self.selected_trace += self.diagonal[j]
+        self.remaining[j] = False
+        self.order.append(j)
+
+    def unexplained(self):
+        """
+        The variance left by the selection: tr(R) when the residual is tracked and tr(cov) - tr(cov_SS) otherwise.
+        """
+        if self.schur is not None:
+            return max(np.trace(self.schur.residual), 0.0)
+        return self.total_trace - self.selected_trace
+
+
+def _trace_scores(state):
+    """
+    tr(cov_SS) grows by cov_jj.
+    """
+    return state.diagonal
+
+
+def _residual_variance_scores(state):
+    """
+    The variance of all neurons explained by j given the selected ones, |R_:j|^2 / R_jj.
+    """
+    return state.schur.gains()[0]
+
+
+def _leverage_scores(state):
+    """
+    Leverage of each neuron on the top eigen vectors of cov leaving at most alpha of the trace out.
+    """
+    if state.leverage is None:
+        eigs, vectors = np.linalg.eigh(state.cov)
+        eigs, vectors = eigs[::-1], vectors[:, ::-1]
+        tail = np.sum(eigs) - np.cumsum(eigs)
+        k = min(np.searchsorted(-tail, -state.alpha) + 1, len(eigs))
+        state.leverage = np.sum(vectors[:, :k] ** 2, axis=1)
+    return state.leverage
+
+
+selection_criteria = {
+    "trace": (_trace_scores, False),
+    "residual_variance": (_residual_variance_scores, True),
+    "leverage": (_leverage_scores, True),
+}
+
+
+def _greedy(cov, alpha, criterion="trace"):
+    """
+    Select neurons one at a time by the best score of a criterion over all remaining candidates until the unexplained
+    variance is at most alpha.
+
+    :param cov: The covariance matrix of the layer
+    :param alpha: The variance the removed neurons may leave unexplained
+    :param criterion: 'trace', 'residual_variance' or 'leverage'. See selection_criteria.
+    :return: neurons, excluded
+    """
+    score_function, track_residual = selection_criteria[criterion]
+    state = _Selection(cov, alpha, track_residual=track_residual)
     possible = np.arange(cov.shape[0])
-    neurons = []
-    steps = 0
-    while len(neurons) < len(possible):
-        best_choice = 1e100
-        best_index = None
-        for j in possible:
-            if j in neurons:
-                continue
 
-            n_p_j = neurons + [j]
-            reduced_cov = cov[np.ix_(n_p_j, n_p_j)]
-            residual = -np.trace(reduced_cov)
-
-            if residual < best_choice:
-                best_choice = residual
-                best_index = j
-
-        if best_index is not None:
-            neurons.append(best_index)
-        else:
-            raise Exception("No greedy choice")
+    steps = 0
+    while np.any(state.remaining):
+        scores = np.where(state.remaining, score_function(state), -np.inf)
+        state.add(int(np.argmax(scores)))
 
-        model_difference = np.trace(cov) + best_choice
-        constraint.append(model_difference)
+        model_difference = state.unexplained()
         if model_difference <= alpha:
             logging.debug('Finished after %d - %f' % (steps, model_difference))
             break
@@ -96,39 +240,111 @@ def _greedy(cov, alpha):
             logging.debug('Step %d - %f' % (steps, model_difference))
         steps += 1
 
-    # if self.plot:
-    #     plt.figure()
-    #     plt.plot(constraint)
-    #     plt.title("Model difference")
-    #     plt.draw()
+    neurons = sorted(state.order)
+    return neurons, possible[state.remaining].tolist()
 
-    neurons.sort()
-    return neurons, list(set(possible).difference(neurons))
 
+def _pivoted_cholesky(cov, alpha):
+    """
+    Select neurons by pivoted Cholesky until the variance they leave unexplained is at most alpha.
+    """
+    pivots, residual_traces = pivoted_cholesky(cov, tol=alpha)
+    logging.debug('Finished after %d - %f' % (len(pivots), residual_traces[-1]))
+    neurons = sorted(pivots.tolist())
+    return neurons, list(set(range(cov.shape[0])).difference(neurons))
 
-def _group_sparse(cov):
-    # min tr(ASA^T - 2AS) + lambda * sum(norm(A[:, j]))
-    lmb = 0.9
 
-    def objective_function(a):
-        return np.trace(a.dot(cov).dot(a.T) - 2 * a.dot(cov)) \
-               + lmb * np.sum([np.linalg.norm(a[:, j]) for j in range(a.shape[0])])
+def _group_soft_threshold(A, threshold):
+    """
+    The proximal operator of threshold * sum_j |A_:j|, which shrinks every column towards zero by threshold.
+    """
+    norms = np.linalg.norm(A, axis=0)
+    return A * np.maximum(1 - threshold / np.maximum(norms, np.finfo(float).tiny), 0)
 
-    max_iterations = 10000
-    etha = 0.1
+
+def _spectral_norm(cov):
     n = cov.shape[0]
-    I = np.eye(n)
-    # Initial
-    A = np.eye(n)
+    return max(SLA.eigvalsh(cov, subset_by_index=[n - 1, n - 1])[0], np.finfo(float).tiny)
+
+
+def _group_sparse(cov, lmb=0.9, A=None, tol=1e-6, max_iterations=10000, spectral_norm=None):
+    """
+    Solve min tr(A cov A^T - 2 A cov) + lmb * sum_j |A_:j| with FISTA. The gradient 2 (A cov - cov) is Lipschitz with
+    constant 2 |cov|_2, which gives the step size, and the proximal step sets whole columns to zero. The momentum is
+    restarted whenever it points against the proximal step.
+
+    :param cov: The covariance matrix of the layer
+    :param lmb: The weight of the group penalty
+    :param A: The initial solution. The identity by default.
+    :param tol: Stop when a step changes A by less than tol relative to its Frobenius norm
+    :param max_iterations: The maximal number of steps
+    :param spectral_norm: |cov|_2 if it is already known
+    :return: A. The neurons of the zero columns are not needed to reconstruct the layer.
+    """
+    cov = np.asarray(cov, dtype=np.float64)
+    step = 1 / (2 * (spectral_norm or _spectral_norm(cov)))
+    A = np.eye(cov.shape[0]) if A is None else np.array(A, dtype=np.float64)
+    Y = A
+    t = 1.0
     steps = 0
     while steps < max_iterations:
+        A_next = _group_soft_threshold(Y - 2 * step * (Y.dot(cov) - cov), step * lmb)
+        difference = A_next - A
+        A = A_next
+        steps += 1
+        if np.sum(difference * difference) <= tol ** 2 * max(np.sum(A * A), 1.0):
+            break
 
-        loss = objective_function(A)
+        if np.sum((Y - A) * difference) > 0:
+            t = 1.0
+        t_next = (1 + np.sqrt(1 + 4 * t * t)) / 2
+        Y = A + ((t - 1) / t_next) * difference
+        t = t_next
 
-        A = A - etha * (cov.dot(A) - 2 * cov + lmb * I)
+    logging.debug('Group sparse with lambda %f finished after %d steps' % (lmb, steps))
+    return A
 
-        if loss < 1e-4:
-            break
-        steps += 1
 
-    return A
+def group_sparse_path(cov, lambdas=None, num=20, ratio=1e-3, **options):
+    """
+    Solve the group sparse problem for decreasing lmb, each warm started from the previous solution.
+    By default lmb runs over num log spaced values from 2 max_j |cov_:j|, where A = 0 is optimal, down to ratio of it.
+
+    :param cov: The covariance matrix of the layer
+    :param lambdas: The values of lmb
+    :return: generator of (lmb, A)
+    """
+    cov = np.asarray(cov, dtype=np.float64)
+    if lambdas is None:
+        lmb_max = 2 * np.max(np.linalg.norm(cov, axis=0))
+        lambdas = lmb_max * np.logspace(0, np.log10(ratio), num)
+    spectral_norm = _spectral_norm(cov)
+    A = np.zeros_like(cov)
+    for lmb in sorted(lambdas, reverse=True):
+        A = _group_sparse(cov, lmb, A=A, spectral_norm=spectral_norm, **options)
+        yield lmb, A
+
+
+def _unexplained_variance(cov, neurons):
+    """
+    tr(cov) - tr(cov_:S pinv(cov_SS) cov_S:), the variance left by the best linear reconstruction from neurons.
+    """
+    if len(neurons) == 0:
+        return np.trace(cov)
+    return np.trace(cov) - np.trace(cov[:, neurons].dot(LA.pinv(cov[np.ix_(neurons, neurons)])).dot(cov[neurons, :]))
+
+
+def _group_sparse_selection(cov, alpha, **options):
+    """
+    Follow the group sparse path until the neurons of the non zero columns leave at most alpha of the variance
+    unexplained.
+    """
+    possible = np.arange(cov.shape[0])
+    for lmb, A in group_sparse_path(cov, **options):
+        neurons = possible[np.linalg.norm(A, axis=0) > 0]
+        model_difference = _unexplained_variance(cov, neurons)
+        logging.debug('Lambda %f - %d neurons - %f' % (lmb, len(neurons), model_difference))
+        if model_difference <= alpha:
+            return neurons.tolist(), possible[np.linalg.norm(A, axis=0) == 0].tolist()
+
+    return possible.tolist(), []
@@ -0,0 +1,380 @@
+"""
+Covariance contains the engines used to accumulate inter layer covariance matrices from layer outputs.
+"""
+import logging
+import os
+import time
+
+import numpy as np
+
+
+class CovarianceAccumulator(object):
+    """
+    Accumulates the second moment of a layer's flattened output one compute batch at a time.
+
+    Each batch is reduced with a single matrix product X^T X instead of summing per sample outer products.
+    """
+
+    def __init__(self, xp=np, dtype=None, channel_axis=None):
+        """
+        :param xp: The array module to compute with (numpy or cupy)
+        :param dtype: The dtype used for accumulation. Defaults to the dtype of the layer output.
+        :param channel_axis: If set, every spatial position is treated as a sample and the covariance is taken
+            over the channels only. Use -1 for channels last and 1 for channels first outputs.
+        """
+        self.xp = xp
+        self.dtype = dtype
+        self.channel_axis = channel_axis
+        self.outer_sum = None
+        self.sum = None
+        self.num_samples = 0
+        self.num_batches = 0
+
+    state_names = ["outer_sum", "sum", "num_samples", "num_batches"]
+
+    def flatten(self, layer_out):
+        """
+        Reshape a batch of layer outputs into a (samples, features) matrix.
+        """
+        if self.channel_axis is not None and layer_out.ndim > 2:
+            x = self.xp.moveaxis(layer_out, self.channel_axis, -1)
+            x = x.reshape(-1, x.shape[-1])
+        else:
+            x = layer_out.reshape(layer_out.shape[0], -1)
+        if self.dtype is not None:
+            x = x.astype(self.dtype, copy=False)
+        return x
+
+    def update(self, layer_out):
+        """
+        Add a batch of layer outputs to the accumulator.
+        :param layer_out: array of shape (batch, ...)
+        :return: self
+        """
+        x = self.flatten(layer_out)
+        gram = x.T.dot(x)
+        if self.outer_sum is None:
+            self.outer_sum = gram
+            self.sum = x.sum(axis=0)
+        else:
+            self.outer_sum += gram
+            self.sum += x.sum(axis=0)
+        self.num_samples += x.shape[0]
+        self.num_batches += 1
+        return self
+
+    def merge(self, other):
+        """
+        Merge the sums of another accumulator into this one.
+        :param other: CovarianceAccumulator
+        :return: self
+        """
+        if other.num_samples > 0:
+            if self.outer_sum is None:
+                self.outer_sum = other.outer_sum.copy()
+                self.sum = other.sum.copy()
+            else:
+                self.outer_sum += other.outer_sum
+                self.sum += other.sum
+            self.num_samples += other.num_samples
+            self.num_batches += other.num_batches
+        return self
+
+    def get_state(self):
+        """
+        The accumulated statistics as a dict of host arrays, e.g. for pickling or saving.
+        """
+        state = {}
+        for name in self.state_names:
+            value = getattr(self, name)
+            state[name] = value.get() if hasattr(value, "get") else value
+        return state
+
+    def set_state(self, state):
+        """
+        Restore statistics from get_state.
+        :return: self
+        """
+        for name in self.state_names:
+            value = state[name]
+            if isinstance(value, np.ndarray) and value.ndim > 0:
+                value = self.xp.asarray(value)
+            elif value is not None:
+                value = int(value)
+            setattr(self, name, value)
+        return self
+
+    @property
+    def mean(self):
+        return self.sum / self.num_samples
+
+    def covariance(self):
+        """
+        The accumulated outer product sum averaged over the number of compute batches.
+        """
+        return self.outer_sum / self.num_batches
+
+
+class StreamingCovarianceAccumulator(CovarianceAccumulator):
+    """
+    Accumulates the mean and the centered second moment of a layer's flattened output.
+
+    Batches are merged with Chan's parallel update so that a full dataset can be streamed in chunks with a
+    memory footprint independent of its size.
+    """
+
+    def __init__(self, xp=np, dtype=np.float64, channel_axis=None):
+        super(StreamingCovarianceAccumulator, self).__init__(xp=xp, dtype=dtype, channel_axis=channel_axis)
+        self._mean = None
+        self.m2 = None
+
+    state_names = ["_mean", "m2", "num_samples", "num_batches"]
+
+    @property
+    def mean(self):
+        return self._mean
+
+    def update(self, layer_out):
+        x = self.flatten(layer_out)
+        mean = x.mean(axis=0)
+        centered = x - mean
+        self._merge(x.shape[0], mean, centered.T.dot(centered))
+        self.num_batches += 1
+        return self
+
+    def merge(self, other):
+        """
+        Merge the statistics of another accumulator into this one.
+        :param other: StreamingCovarianceAccumulator
+        :return: self
+        """
+        if other.num_samples > 0:
+            self._merge(other.num_samples, other.mean, other.m2)
+            self.num_batches += other.num_batches
+        return self
+
+    def _merge(self, n_b, mean_b, m2_b):
+        n_a = self.num_samples
+        n = n_a + n_b
+        if n_a == 0:
+            self._mean = mean_b.copy()
+            self.m2 = m2_b.copy()
+        else:
+            delta = mean_b - self._mean
+            self._mean += delta * (n_b / n)
+            self.m2 += m2_b
+            self.m2 += self.xp.outer(delta, delta) * (n_a * n_b / n)
+        self.num_samples = n
+
+    def covariance(self):
+        """
+        The unbiased centered covariance of all samples seen so far.
+        """
+        return self.m2 / max(self.num_samples - 1, 1)
+
+
+reductions = ["flatten", "channel", "auto"]
+
+
+def channel_axis_for(layer_out, reduction="flatten", channels_first=False, max_covariance_mb=1024):
+    """
+    Decide how a layer output is reduced before its covariance is accumulated.
+
+    :param layer_out: A batch of layer outputs
+    :param reduction: 'flatten' uses all features, 'channel' uses the channels of convolutional outputs and 'auto'
+        uses the channels only if the flattened covariance would exceed max_covariance_mb
+    :param channels_first: Whether the channel axis is 1 (chainer) or -1 (keras)
+    :param max_covariance_mb: The memory budget of a single flattened covariance matrix in 'auto' mode
+    :return: The channel axis or None to flatten
+    """
+    if layer_out.ndim <= 2 or reduction == "flatten":
+        return None
+    channel_axis = 1 if channels_first else -1
+    if reduction == "channel":
+        return channel_axis
+    elif reduction == "auto":
+        width = int(np.prod(layer_out.shape[1:]))
+        size_mb = width * width * layer_out.dtype.itemsize / 2 ** 20
+        if size_mb > max_covariance_mb:
+            logging.info("Using channel covariance for output %s (flattened %.0f MB)" % (layer_out.shape, size_mb))
+            return channel_axis
+        return None
+    else:
+        raise ValueError("Unknown reduction %s" % reduction)
+
+
+def accumulator_options_for(model_wrapper, streaming=False, accumulation_dtype=None, conv_reduction="flatten",
+                            max_covariance_mb=1024, **options):
+    """
+    The make_accumulator options for the layer outputs of model_wrapper from the settings of calc_eigs.
+    """
+    return dict(streaming=streaming, dtype=accumulation_dtype, reduction=conv_reduction,
+                channels_first=model_wrapper.model_type == "chainer", max_covariance_mb=max_covariance_mb)
+
+
+def make_accumulator(layer_out, streaming=False, xp=np, dtype=None, reduction="flatten", channels_first=False,
+                     max_covariance_mb=1024):
+    """
+    Create the accumulator for a layer from the first batch of its outputs.
+    See channel_axis_for for the reduction options.
+    """
+    channel_axis = channel_axis_for(layer_out, reduction=reduction, channels_first=channels_first,
+                                    max_covariance_mb=max_covariance_mb)
+    return accumulator_for(channel_axis, streaming=streaming, xp=xp, dtype=dtype)
+
+
+def accumulator_for(channel_axis, streaming=False, xp=np, dtype=None, **options):
+    """
+    Create an empty accumulator with a known channel axis, e.g. to restore a saved state.
+    """
+    if streaming:
+        return StreamingCovarianceAccumulator(xp=xp, dtype=dtype or np.float64, channel_axis=channel_axis)
+    return CovarianceAccumulator(xp=xp, dtype=dtype, channel_axis=channel_axis)
+
+
+class CovarianceCheckpoint(object):
+    """
+    Periodically saves the accumulators of a running covariance computation so that an interrupted run can resume.
+
+    The checkpoint holds the state of every layer accumulator, the number of processed compute batches (cursor),
+    the sample indices and a signature of the settings. It is only resumed if the signature and indices match,
+    and since the remaining batches are added in the same order the result is bit identical to an uninterrupted run.
+    """
+    file_name = "checkpoint.npz"
+
+    def __init__(self, path, signature, indices=None, interval=10):
+        """
+        :param path: The directory of the checkpoint
+        :param signature: A string identifying the model and the settings of the computation
+        :param indices: The sample indices of the computation, if any
+        :param interval: Save every interval compute batches
+        """
+        self.path = path
+        self.signature = signature
+        self.indices = np.asarray([] if indices is None else indices, dtype=np.int64)
+        self.interval = interval
+
+    @property
+    def file(self):
+        return os.path.join(self.path, self.file_name)
+
+    def load(self, new_accumulator):
+        """
+        :param new_accumulator: function creating an empty accumulator given a channel axis
+        :return: (cursor, accumulators) or (0, []) if there is no matching checkpoint
+        """
+        if not os.path.isfile(self.file):
+            return 0, []
+        with np.load(self.file) as data:
+            if str(data["signature"]) != self.signature or not np.array_equal(data["indices"], self.indices):
+                logging.warning("Ignoring checkpoint '%s' of a different computation" % self.file)
+                return 0, []
+
+            accumulators = []
+            for l in range(int(data["num_layers"])):
+                channel_axis = int(data["layer_%d_channel_axis" % l])
+                accumulator = new_accumulator(None if channel_axis == 0 else channel_axis)
+                accumulator.set_state({name: data["layer_%d_%s" % (l, name)] for name in accumulator.state_names})
+                accumulators.append(accumulator)
+            cursor = int(data["cursor"])
+
+        logging.info("Resuming covariance computation after %d batches from '%s'" % (cursor, self.file))
+        return cursor, accumulators
+
+    def maybe_save(self, cursor, accumulators):
+        if self.interval and cursor % self.interval == 0:
+            self.save(cursor, accumulators)
+
+    def save(self, cursor, accumulators):
+        """
+        Atomically write the checkpoint.
+        :param cursor: The number of processed compute batches
+        :param accumulators: The layer accumulators
+        """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        elements = {
+            "signature": self.signature,
+            "indices": self.indices,
+            "cursor": cursor,
+            "num_layers": len(accumulators),
+        }
+        for l, accumulator in enumerate(accumulators):
+            # channel axes are never 0, which marks a flattened output
+            elements["layer_%d_channel_axis" % l] = accumulator.channel_axis or 0
+            for name, value in accumulator.get_state().items():
+                elements["layer_%d_%s" % (l, name)] = value
+
+        tmp_file = os.path.join(self.path, "tmp_" + self.file_name)
+        np.savez(tmp_file, **elements)
+        os.replace(tmp_file, self.file)
+        logging.debug("Saved covariance checkpoint after %d batches" % cursor)
+
+    def clear(self):
+        if os.path.isfile(self.file):
+            os.remove(self.file)
+
+
+def iterate_chunks(data, chunk_size):
+    """
+    Yield consecutive chunks of samples.
+
+    :param data: An indexable array such as a numpy memory map, or an iterable yielding batches
+    :param chunk_size: The number of samples per chunk when data is indexable
+    :return: generator of chunks
+    """
+    if hasattr(data, "__getitem__") and hasattr(data, "__len__"):
+        for start in range(0, len(data), chunk_size):
+            yield data[start:start + chunk_size]
+    else:
+        for chunk in data:
+            yield chunk
+
+
+def outer_product_loop(x):
+    """
+    Reference implementation summing one outer product per sample.
+    """
+    cov = None
+    for fxi in x:
+        fxi = fxi.ravel()
+        dot = np.outer(fxi, fxi)
+        if cov is None:
+            cov = dot
+        else:
+            cov += dot
+    return cov
+
+
+def benchmark(widths=(100, 250, 500, 1000), num_samples=100, repeat=3, dtype=np.float32):
+    """
+    Compare the per sample outer product loop with the batched matrix product for a range of layer widths.
+
+    :param widths: The layer widths to test
+    :param num_samples: The size of each compute batch
+    :param repeat: Number of timings per width; the best is reported
+    :param dtype: The dtype of the generated layer outputs
+    :return: A list of (width, loop_time, gemm_time, speedup)
+    """
+    results = []
+    for width in widths:
+        x = np.random.standard_normal((num_samples, width)).astype(dtype)
+
+        loop_time = np.inf
+        gemm_time = np.inf
+        for _ in range(repeat):
+            start = time.time()
+            expected = outer_product_loop(x)
+            loop_time = min(loop_time, time.time() - start)
+
+            start = time.time()
+            actual = CovarianceAccumulator().update(x).outer_sum
+            gemm_time = min(gemm_time, time.time() - start)
+
+        assert np.allclose(expected, actual, rtol=1e-3, atol=1e-3)
+
+        speedup = loop_time / max(gemm_time, 1e-12)
+        logging.info("width=%d loop=%.5fs gemm=%.5fs speedup=%.1fx" % (width, loop_time, gemm_time, speedup))
+        results.append((width, loop_time, gemm_time, speedup))
+
+    return results
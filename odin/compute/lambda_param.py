@@ -4,6 +4,7 @@ import numpy as np
 import scipy.optimize as opt
 
 import odin.plot as oplt
+from .spectrum import compress_spectrum
 
 
 def plot_lambdas(lambdas, bounds, layer_widths, prefix="line"):
@@ -64,22 +65,52 @@ def generate_n_sphere_points(r, n, num=100):
     return x.T
 
 
+# Methods minimizing the regularized objective with exact second order information
+newton_methods = ["Newton-CG", "trust-ncg", "trust-krylov"]
+
+
 class LambdaOptimizer:
     current_result = None
 
-    def __init__(self, model_wrapper, sanitize_eigs=False):
+    def __init__(self, model_wrapper, sanitize_eigs=False, spectrum_tol=None):
+        """
+        :param model_wrapper:
+        :param sanitize_eigs: Raise eigen values below 1 to 1
+        :param spectrum_tol: Evaluate the degrees of freedom on spectra compressed with this absolute error, see
+            odin.compute.spectrum.compress_spectrum. The compressed spectra stored with the covariance are used if
+            they exist.
+        """
         self.model_wrapper = model_wrapper
 
-        eig_rows = model_wrapper.get_element("inter_layer_covariance", "eigen_values")
-        # remove negative eigenvalues
-        if sanitize_eigs:
-            epsilon = 1
-            for i, eigs in enumerate(eig_rows):
-                eigs[eigs < epsilon] = epsilon
-        # no imaginary part
-        eig_rows = np.abs(eig_rows)
-
-        self.layer_eigen_values = eig_rows
+        weight_rows = None
+        if spectrum_tol is not None and not sanitize_eigs:
+            group = model_wrapper.get_group("inter_layer_covariance")
+            if "spectrum_values" in group and "spectrum_weights" in group:
+                eig_rows = group["spectrum_values"]
+                weight_rows = group["spectrum_weights"]
+
+        if weight_rows is None:
+            eig_rows = model_wrapper.get_element("inter_layer_covariance", "eigen_values")
+            # remove negative eigenvalues
+            if sanitize_eigs:
+                epsilon = 1
+                for i, eigs in enumerate(eig_rows):
+                    eigs[eigs < epsilon] = epsilon
+            # no imaginary part
+            eig_rows = [np.abs(eigs) for eigs in eig_rows]
+
+            if spectrum_tol is not None:
+                eig_rows, weight_rows = zip(*[compress_spectrum(eigs, tol=spectrum_tol) for eigs in eig_rows])
+
+        # Padded eigen values with a mask per layer so that all layers are evaluated in a single expression
+        max_width = max(len(eigs) for eigs in eig_rows)
+        padded_eigen_values = np.zeros((len(eig_rows), max_width))
+        padded_weights = None if weight_rows is None else np.zeros((len(eig_rows), max_width))
+        for i, eigs in enumerate(eig_rows):
+            padded_eigen_values[i, :len(eigs)] = eigs
+            if weight_rows is not None:
+                padded_weights[i, :len(eigs)] = weight_rows[i]
+        self._set_eigen_values(padded_eigen_values, [len(eigs) for eigs in eig_rows], padded_weights)
 
         self.model = model_wrapper.model
 
@@ -87,15 +118,45 @@ class LambdaOptimizer:
         self.initial_widths = np.array([l.units for l in layers])
         self.num_layers = len(self.model_wrapper.layers()) - 1  # Do not include the last layer
 
-    def objective_function(self, lamb):
-        last = self.degree_of_freedom(lamb=lamb[0], layer=0)
-        s = 0
-        for layer in range(1, self.num_layers):
-            n_l = self.degree_of_freedom(lamb[layer], layer)
-            s += n_l * last
-            last = n_l
+    def _set_eigen_values(self, padded_eigen_values, widths, padded_weights=None):
+        """
+        :param padded_eigen_values: (layers, max width) array with the eigen values of each layer first in its row
+        :param widths: The number of eigen values of each layer
+        :param padded_weights: The multiplicity of each eigen value in a compressed spectrum. One if not given.
+        """
+        self.padded_eigen_values = padded_eigen_values
+        self.eigen_widths = np.asarray(widths)
+        self.eigen_mask = np.arange(padded_eigen_values.shape[1]) < self.eigen_widths[:, None]
+        if padded_weights is None:
+            padded_weights = self.eigen_mask.astype(float)
+        self.eigen_weights = padded_weights
+        self._weighted_eigen_values = padded_weights * padded_eigen_values
+        # Added to the denominators of padded entries to avoid 0/0
+        self._padding = (~self.eigen_mask).astype(float)
+        self.layer_eigen_values = [row[:width] for row, width in zip(padded_eigen_values, widths)]
+        self.layer_eigen_weights = [row[:width] for row, width in zip(padded_weights, widths)]
+
+    @classmethod
+    def from_eigen_values(cls, padded_eigen_values, widths, num_layers, padded_weights=None):
+        """
+        Create an optimizer without a model, e.g. in a worker process.
+        :param padded_eigen_values: See _set_eigen_values
+        :param widths: The number of eigen values of each layer
+        :param num_layers: The number of optimized layers
+        :param padded_weights: See _set_eigen_values
+        :return: LambdaOptimizer
+        """
+        l_opt = cls.__new__(cls)
+        l_opt.model_wrapper = None
+        l_opt.model = None
+        l_opt._set_eigen_values(padded_eigen_values, widths, padded_weights)
+        l_opt.initial_widths = np.sum(l_opt.eigen_weights, axis=1)
+        l_opt.num_layers = num_layers
+        return l_opt
 
-        return s
+    def objective_function(self, lamb):
+        n_l = self.degrees_of_freedom(lamb)
+        return np.sum(n_l[1:] * n_l[:-1])
 
     def plot_degree_of_freedom(self):
         X = np.linspace(0, 10)
@@ -106,19 +167,17 @@ class LambdaOptimizer:
     def optimize_initial_lambda(self):
         # Solve N(l) = iw by min |N(l) - iw|
         iw = self.initial_widths
-        dof = self.degree_of_freedom
         n = self.num_layers
 
         def fun(lambs):
-            n_of_lamb = [dof(lamb, layer) for layer, lamb in enumerate(lambs)]
-            return np.linalg.norm(n_of_lamb - iw)
+            return np.linalg.norm(self.degrees_of_freedom(lambs) - iw[:n])
 
         lamb0 = np.ones(n) * 0.1
         res = opt.minimize(fun, lamb0)
         initial_lamb = res.x
         return initial_lamb
 
-    def _optimize_SLSQP(self, bound=1.0, debug=False):
+    def _optimize_SLSQP(self, bound=1.0, debug=False, x0=None):
         n = self.num_layers
 
         def bounding(l):
@@ -147,7 +206,7 @@ class LambdaOptimizer:
         else:
             callback = None
 
-        lamb0 = np.ones(n) * 0.1
+        lamb0 = np.ones(n) * 0.1 if x0 is None else x0
 
         obj = self.objective_function
         rho = bound
@@ -174,11 +233,15 @@ class LambdaOptimizer:
 
         return result
 
-    def _optimize_newton_cg(self, rho=1, debug=False, regularizing="sq"):
+    def _optimize_newton_cg(self, rho=1, debug=False, regularizing="sq", x0=None, method="Newton-CG"):
+        """
+        Minimize N(x^2) + rho * R(x) with exact gradients and Hessian-vector products.
+        :param method: 'Newton-CG' or one of the trust region methods 'trust-ncg' and 'trust-krylov'
+        """
         obj = self.objective_function
         n = self.num_layers
         ones = np.ones(n)
-        lamb0 = ones * 0.1
+        lamb0 = ones * 0.1 if x0 is None else x0
 
         def abs_regularizer(x): return np.sum(np.abs(x))
 
@@ -188,10 +251,16 @@ class LambdaOptimizer:
 
         def abs_regularizer_diff(x): return np.sign(x)
 
-        def sq_regularizer_diff(x): return 2*np.sum(x)
+        def sq_regularizer_diff(x): return 2 * x
 
         regularizer_diff = sq_regularizer_diff if regularizing == "sq" else abs_regularizer_diff
 
+        def abs_regularizer_diff2(x): return np.zeros_like(x)
+
+        def sq_regularizer_diff2(x): return 2 * np.ones_like(x)
+
+        regularizer_diff2 = sq_regularizer_diff2 if regularizing == "sq" else abs_regularizer_diff2
+
         def lagrangian(x):
             return obj(x ** 2) + rho * regularizer(x)
 
@@ -200,29 +269,36 @@ class LambdaOptimizer:
         def jac(x):
             return 2 * x * jacobian(x ** 2) + rho * regularizer_diff(x)
 
+        hessian_vector_product = self.hessian_vector_product
+
+        def hessp(x, p):
+            # Chain rule for lambda = x^2: H = diag(2 grad N) + diag(2x) H_N diag(2x)
+            lamb = x ** 2
+            return 2 * jacobian(lamb) * p + 2 * x * hessian_vector_product(lamb, 2 * x * p) \
+                + rho * regularizer_diff2(x) * p
+
         result = opt.minimize(lagrangian, lamb0,
                               jac=jac,
-                              method='Newton-CG',
+                              hessp=hessp,
+                              method=method,
                               options={"disp": debug})
 
         return result
 
     def optimize(self, method, **kwargs):
-        dof = self.degree_of_freedom
         if method == "SLSQP":
             result = self._optimize_SLSQP(**kwargs)
             lambdas = np.square(result.x)
 
-        elif method == "Newton-CG":
-            result = self._optimize_newton_cg(**kwargs)
+        elif method in newton_methods:
+            result = self._optimize_newton_cg(method=method, **kwargs)
             lambdas = np.square(result.x)
         else:
             raise ValueError("Unkown method %s" % method)
 
         logging.debug(str(result))
 
-        layer_widths = [dof(lamb, layer) for layer, lamb in enumerate(lambdas)]
-        layer_widths = np.int32(np.ceil(layer_widths))
+        layer_widths = np.int32(np.ceil(self.degrees_of_freedom(lambdas)))
 
         self.current_result = result
         if not result.success:
@@ -231,8 +307,7 @@ class LambdaOptimizer:
         return lambdas, layer_widths
 
     def calc_layer_widths(self, lambdas):
-        layer_widths = np.array([self.degree_of_freedom(lamb, layer) for layer, lamb in enumerate(lambdas)])
-        return layer_widths
+        return self.degrees_of_freedom(lambdas)
 
     def n_sphere_lambda_dof(self):
         n = self.num_layers
@@ -250,50 +325,283 @@ class LambdaOptimizer:
         return sphere, layer_widths
 
     def range_lambda_dof(self, line, method="SLSQP"):
-        l_arr = []
-        layer_widths = []
-        success = []
-
-        for bound in line:
-            if method.upper() == "SLSQP":
-                lambdas, m_ls = self.optimize(bound=bound, debug=False)
-            elif method.upper() == "NEWTON-CG":
-                lambdas, m_ls = self.optimize(method="Newton-CG", rho=bound)
-            else:
-                raise ValueError(method)
-
-            l_arr.append(lambdas)
-            layer_widths.append(m_ls)
-            success.append(self.current_result.success)
-
-        # layer_widths = np.array([self.calc_layer_widths(lambdas) for lambdas in l_arr])
-
-        return l_arr, layer_widths, success
-
-    def jacobian(self, lamb):
+        """
+        Solve for every bound in line, warm starting each solve from the previous solution.
+        :return: lambdas, layer widths and success for each bound in the order of line
+        """
+        order = np.argsort(line)
+        _, lambdas, layer_widths, success = self.lambda_path(np.asarray(line)[order], method=method, refine=False)
+
+        inverse = np.argsort(order)
+        return list(lambdas[inverse]), list(layer_widths[inverse]), list(success[inverse])
+
+    def lambda_path(self, grid, method="Newton-CG", refine=True, min_step=None, max_points=None, **kwargs):
+        """
+        Continuation solver for a grid of rho (Newton methods) or bound (SLSQP) values.
+
+        The grid is sorted and each solve starts from the solution of its left neighbour. With refine, midpoints are
+        inserted between neighbours whose integer layer widths differ until each change is located within min_step,
+        so a coarse grid gives the full piecewise constant path of layer widths.
+
+        :param grid: The values of rho or bound
+        :param method: 'SLSQP' or one of newton_methods
+        :param refine: Adaptively refine the grid where the layer widths change
+        :param min_step: The resolution of the refinement. Defaults to 1/64 of the mean grid spacing.
+        :param max_points: The maximum number of points on the path. Defaults to 8 times the grid size.
+        :param kwargs: Passed on to optimize
+        :return: grid, lambdas, layer_widths and success as arrays sorted by the grid value
+        """
+        if method.upper() == "SLSQP":
+            method, parameter = "SLSQP", "bound"
+        elif method.upper() == "NEWTON-CG":
+            method, parameter = "Newton-CG", "rho"
+        elif method in newton_methods:
+            parameter = "rho"
+        else:
+            raise ValueError(method)
+
+        grid = np.sort(np.asarray(grid, dtype=float))
+        if min_step is None:
+            min_step = (grid[-1] - grid[0]) / max(len(grid) - 1, 1) / 64
+        if max_points is None:
+            max_points = 8 * len(grid)
+
+        iterations = [0]
+
+        def solve(value, x0):
+            lambdas, layer_widths = self.optimize(method=method, x0=x0, **{parameter: value}, **kwargs)
+            result = self.current_result
+            iterations[0] += result.nit
+            return value, result.x, lambdas, layer_widths, result.success
+
+        path = []
+        x0 = None
+        for value in grid:
+            point = solve(value, x0)
+            path.append(point)
+            x0 = point[1]
+
+        while refine and len(path) < max_points:
+            refined = [path[0]]
+            inserted = 0
+            for left, right in zip(path[:-1], path[1:]):
+                if len(path) + inserted < max_points and right[0] - left[0] > min_step \
+                        and np.any(left[3] != right[3]):
+                    refined.append(solve((left[0] + right[0]) / 2, left[1]))
+                    inserted += 1
+                refined.append(right)
+
+            if inserted == 0:
+                break
+            path = refined
+
+        logging.info("Solved %d points on the lambda path with %d iterations" % (len(path), iterations[0]))
+        self.path_iterations = iterations[0]
+
+        values, _, lambdas, layer_widths, success = zip(*path)
+        return np.array(values), np.array(lambdas), np.array(layer_widths), np.array(success)
+
+    def optimize_batch(self, rho_range, lamb0=None, tol=1e-6, max_iter=200, min_lambda=1e-12, coarse_size=32):
+        """
+        Minimize N(lambda) + rho * sum(lambda) subject to lambda >= min_lambda for all values of rho at once.
+
+        This is the problem solved by the Newton methods with the 'sq' regularizer, written in lambda instead of
+        x = sqrt(lambda). Every iteration is a projected Newton step on the (len(rho_range), layers) lambda matrix:
+        bound lambdas with a positive gradient are held at the bound, the Hessian of the free lambdas is shifted to be
+        positive definite and a batched Armijo backtracking chooses the step length per row. Rows that have converged
+        are no longer updated. Dense grids are first solved on every k-th rho and start from the interpolated
+        solution.
+
+        :param rho_range: The values of rho
+        :param lamb0: Initial lambdas, either for all rows or one per row. Defaults to 0.01 like the Newton methods.
+        :param tol: Converged when the projected gradient is below tol * (1 + rho) in every layer
+        :param max_iter: The maximum number of Newton iterations
+        :param min_lambda: The lower bound of lambda
+        :param coarse_size: Grids with more than this many values are initialized from a coarse solve
+        :return: lambdas, layer_widths and success as arrays in the order of rho_range
+        """
+        rho = np.asarray(rho_range, dtype=float)[:, None]
         n = self.num_layers
-        mu = self.layer_eigen_values
-
-        dof = self.degree_of_freedom
-
-        def der_dof(lamb, layer):
-            return -np.sum([mu_lk / (mu_lk + lamb) ** 2 for mu_lk in mu[layer]])
-
-        jac = np.zeros(n)
-
-        for l in range(0, n):
-            n_der_l = der_dof(lamb[l], l)
-            s = 0
-            if l < n - 1:
-                s += dof(lamb[l + 1], l) * n_der_l
-            if l > 0:
-                s += dof(lamb[l - 1], l) * n_der_l
-            jac[l] = s
+        lamb = np.empty((len(rho), n))
+        if lamb0 is None and coarse_size and len(rho) > coarse_size:
+            order = np.argsort(rho[:, 0])
+            sorted_rho = rho[order, 0]
+            coarse = sorted_rho[np.linspace(0, len(rho) - 1, coarse_size).astype(int)]
+            coarse_lamb, _, _ = self.optimize_batch(coarse, tol=tol, max_iter=max_iter, min_lambda=min_lambda,
+                                                    coarse_size=0)
+            coarse_iterations = self.batch_iterations
+            for i in range(n):
+                lamb[order, i] = np.interp(sorted_rho, coarse, coarse_lamb[:, i])
+        else:
+            coarse_iterations = 0
+            lamb[:] = 0.01 if lamb0 is None else lamb0
+        lamb = np.maximum(lamb, min_lambda)
+
+        def lagrangian(l, r):
+            return self.objective_function_batch(l) + r[:, 0] * np.sum(l, axis=-1)
+
+        active = np.ones(len(rho), dtype=bool)
+        success = np.zeros(len(rho), dtype=bool)
+        identity = np.eye(n)
+        iterations = 0
+        for iterations in range(1, max_iter + 1):
+            l = lamb[active]
+            r = rho[active]
+            n_l, d1, d2 = self._dof_moments(l)
+            neighbours = self._neighbour_sum(n_l)
+            g = d1 * neighbours + r
+            bound = (l <= min_lambda) & (g > 0)
+            projected = np.where(bound, 0.0, g)
+
+            converged = np.all(np.abs(projected) <= tol * (1 + r), axis=-1)
+            rows = np.flatnonzero(active)
+            success[rows[converged]] = True
+            active[rows[converged]] = False
+            if not np.any(active):
+                break
+            keep = ~converged
+            l, r, g, bound, projected = l[keep], r[keep], g[keep], bound[keep], projected[keep]
+
+            # Reduced Newton system on the free lambdas
+            free = ~bound
+            h = self._dense_tridiagonal(d2[keep] * neighbours[keep], d1[keep, :-1] * d1[keep, 1:])
+            h = h * (free[:, :, None] & free[:, None, :]) + identity * bound[:, :, None]
+            shift = np.maximum(0, 1e-8 - np.linalg.eigvalsh(h)[:, 0]) * (1 + np.abs(h).max(axis=(1, 2)))
+            h += shift[:, None, None] * identity
+            direction = -np.linalg.solve(h, projected[..., None])[..., 0]
+            direction[bound] = 0
+
+            f0 = lagrangian(l, r)
+            step = np.ones(len(l))
+            new = l
+            accepted = np.zeros(len(l), dtype=bool)
+            for _ in range(40):
+                candidate = np.maximum(l + step[:, None] * direction, min_lambda)
+                ok = ~accepted & (lagrangian(candidate, r) <= f0 + 1e-4 * np.sum(g * (candidate - l), axis=-1))
+                new = np.where(ok[:, None], candidate, new)
+                accepted |= ok
+                if np.all(accepted):
+                    break
+                step = np.where(accepted, step, step / 2)
+
+            rows = np.flatnonzero(active)
+            lamb[rows] = new
+            # Rows without a descent step cannot make further progress
+            active[rows[~accepted]] = False
+
+        self.batch_iterations = coarse_iterations + iterations
+        logging.info("Solved %d values of rho in %d batched Newton iterations, %d unsuccessful" % (
+            len(rho), self.batch_iterations, np.sum(~success)))
+
+        layer_widths = np.int32(np.ceil(self.degrees_of_freedom(lamb)))
+        return lamb, layer_widths, success
+
+    def objective_function_batch(self, lamb):
+        """
+        The objective for each row of a (..., layers) array of lambdas.
+        """
+        n_l = self.degrees_of_freedom(lamb)
+        return np.sum(n_l[..., 1:] * n_l[..., :-1], axis=-1)
+
+    def _ratios(self, lamb):
+        """
+        The weighted eigen values w * mu and the denominators mu + lambda of the first len(lamb) layers.
+        """
+        lamb = np.asarray(lamb, dtype=float)
+        n = lamb.shape[-1]
+        mu = self.padded_eigen_values[:n]
+        return self._weighted_eigen_values[:n], mu + lamb[..., None] + self._padding[:n]
+
+    def degrees_of_freedom(self, lamb):
+        """
+        N_l(lambda_l) = sum_k w_lk mu_lk / (mu_lk + lambda_l) for all layers l < len(lamb) at once.
+        The weights w_lk are one unless the spectrum is compressed.
+        """
+        mu, denominator = self._ratios(lamb)
+        return np.sum(mu / denominator, axis=-1)
+
+    def _dof_moments(self, lamb):
+        """
+        The degrees of freedom with their first and second derivatives from a single pass over the eigen values.
+        """
+        weighted, denominator = self._ratios(lamb)
+        reciprocal = 1 / denominator
+        terms = weighted * reciprocal
+        n_l = np.sum(terms, axis=-1)
+        terms *= reciprocal
+        d1 = -np.sum(terms, axis=-1)
+        terms *= reciprocal
+        return n_l, d1, 2 * np.sum(terms, axis=-1)
+
+    def dof_derivatives(self, lamb):
+        """
+        dN_l / dlambda_l = -sum_k mu_lk / (mu_lk + lambda_l)^2
+        """
+        mu, denominator = self._ratios(lamb)
+        return -np.sum(mu / denominator ** 2, axis=-1)
+
+    def dof_second_derivatives(self, lamb):
+        """
+        d^2N_l / dlambda_l^2 = 2 sum_k mu_lk / (mu_lk + lambda_l)^3
+        """
+        mu, denominator = self._ratios(lamb)
+        return 2 * np.sum(mu / denominator ** 3, axis=-1)
+
+    @staticmethod
+    def _neighbour_sum(n_l):
+        """
+        N_{l-1} + N_{l+1} with zero outside the network.
+        """
+        s = np.zeros_like(n_l)
+        s[..., 1:] += n_l[..., :-1]
+        s[..., :-1] += n_l[..., 1:]
+        return s
 
-        return jac
+    def jacobian(self, lamb):
+        """
+        Gradient of the objective: N'_l(lambda_l) (N_{l-1}(lambda_{l-1}) + N_{l+1}(lambda_{l+1}))
+        """
+        return self.dof_derivatives(lamb) * self._neighbour_sum(self.degrees_of_freedom(lamb))
+
+    def _hessian_bands(self, lamb):
+        """
+        The diagonal and the off diagonal of the tridiagonal Hessian of the objective.
+        """
+        d1 = self.dof_derivatives(lamb)
+        diagonal = self.dof_second_derivatives(lamb) * self._neighbour_sum(self.degrees_of_freedom(lamb))
+        return diagonal, d1[..., :-1] * d1[..., 1:]
+
+    def hessian(self, lamb):
+        """
+        The Hessian of the objective as a dense (..., n, n) array.
+        """
+        return self._dense_tridiagonal(*self._hessian_bands(lamb))
+
+    @staticmethod
+    def _dense_tridiagonal(diagonal, off_diagonal):
+        n = diagonal.shape[-1]
+        h = np.zeros(diagonal.shape + (n,))
+        i = np.arange(n)
+        h[..., i, i] = diagonal
+        h[..., i[:-1], i[1:]] = off_diagonal
+        h[..., i[1:], i[:-1]] = off_diagonal
+        return h
+
+    def hessian_vector_product(self, lamb, p):
+        """
+        Product of the Hessian of the objective with p. The Hessian is tridiagonal with
+        H_ll = N''_l (N_{l-1} + N_{l+1}) and H_{l,l+1} = N'_l N'_{l+1}.
+        """
+        diagonal, off_diagonal = self._hessian_bands(lamb)
+
+        hp = diagonal * p
+        hp[..., :-1] += off_diagonal * p[..., 1:]
+        hp[..., 1:] += off_diagonal * p[..., :-1]
+        return hp
 
     def degree_of_freedom(self, lamb, layer):
-        return np.sum([my / (my + lamb) for my in self.layer_eigen_values[layer]])
+        mu = self.layer_eigen_values[layer]
+        return np.sum(self.layer_eigen_weights[layer] * mu / (mu + lamb))
 
     def result_text(self):
         lambdas = self.current_result.x
@@ -1,43 +1,102 @@
+"""
+Low rank factorization of the weight matrices of fully connected layers, W ~ P Q with P = U_k S_k and Q = V_k^T from a
+randomized singular value decomposition.
+"""
+import logging
+
 import numpy as np
 import scipy.linalg as LA
-import scipy.optimize as opt
 
 
 def frobenius_norm(matrix):
+    return np.linalg.norm(matrix)
+
+
+def randomized_svd(matrix, rank, oversampling=10, power_iterations=2, seed=None):
+    """
+    Randomized range finder (Halko et al.) followed by a dense SVD of the projected matrix.
+
+    :param matrix: 2d array
+    :param rank: The number of singular triplets
+    :return: U, s, Vt with rank columns, values and rows
+    """
     rows, cols = matrix.shape
-    norm = 0
-    for i in range(rows):
-        for j in range(cols):
-            norm += matrix[i][j] ** 2
-    norm = np.sqrt(norm)
-    return norm
+    rng = np.random.RandomState(seed)
+    omega = rng.standard_normal((cols, min(cols, rank + oversampling)))
+    q, _ = LA.qr(matrix.dot(omega), mode="economic")
+    for _ in range(power_iterations):
+        q, _ = LA.qr(matrix.T.dot(q), mode="economic")
+        q, _ = LA.qr(matrix.dot(q), mode="economic")
+    u, s, vt = LA.svd(q.T.dot(matrix), full_matrices=False)
+    return q.dot(u)[:, :rank], s[:rank], vt[:rank]
 
 
-class LowRankApproximation:
+def factorize(matrix, rank=None, energy=0.99, initial_rank=32, **options):
+    """
+    Factorize matrix ~ P Q at a fixed rank, or at the smallest rank whose singular values capture energy of
+    |matrix|_F^2. In the latter case the rank of the randomized SVD is doubled until the energy is reached.
 
-    def __init__(self, rank):
-        self.norm = frobenius_norm
-        self.rank = rank
+    :param matrix: 2d array, e.g. a Dense kernel of shape (inputs, units)
+    :param rank: The rank. Overrides energy.
+    :param energy: The fraction of the squared Frobenius norm to keep
+    :param initial_rank: The rank of the first attempt when the rank is chosen by energy
+    :return: P of shape (rows, rank), Q of shape (rank, cols)
+    """
+    matrix = np.asarray(matrix, dtype=np.float64)
+    full_rank = min(matrix.shape)
+    if rank is not None:
+        u, s, vt = randomized_svd(matrix, min(rank, full_rank), **options)
+        return u * s, vt
 
-    def truncate(self, target, k):
-        eigen_values, eigen_vectors = LA.eigvals(target)
-        for i in range(k):
-            eigen_values[i] = 0
+    target = energy * np.sum(matrix * matrix)
+    k = min(initial_rank, full_rank)
+    while True:
+        u, s, vt = randomized_svd(matrix, k, **options)
+        captured = np.cumsum(s * s)
+        if captured[-1] >= target or k == full_rank:
+            rank = min(np.searchsorted(captured, target) + 1, k)
+            logging.debug("Captured %.5f of the energy with rank %d/%d" % (
+                captured[rank - 1] / max(captured[-1], np.finfo(float).tiny), rank, full_rank))
+            return u[:, :rank] * s[:rank], vt[:rank]
+        k = min(2 * k, full_rank)
 
-        result = eigen_vectors * eigen_values * eigen_vectors.T
 
-        return result
+def dense_flops(inputs, units, rank=None):
+    """
+    Multiply-add FLOPs per sample of a fully connected layer, or of its rank factorization.
+    """
+    if rank is None:
+        return 2 * inputs * units
+    return 2 * rank * (inputs + units)
 
-    def minimize(self, target):
-        norm = self.norm
 
-        def objective_function(m):
-            return norm(m - target)
+def is_worth_factorizing(inputs, units, rank):
+    return dense_flops(inputs, units, rank) < dense_flops(inputs, units)
 
-        m0 = np.zeros(target.shape)
-        result = opt.minimize(objective_function, m0)
 
-        return result
+class LowRankApproximation:
+
+    def __init__(self, rank=None, energy=0.99):
+        self.norm = frobenius_norm
+        self.rank = rank
+        self.energy = energy
+
+    def factorize(self, target):
+        return factorize(target, rank=self.rank, energy=self.energy)
+
+    def truncate(self, target, k):
+        """
+        The best rank k approximation of target.
+        """
+        p, q = factorize(target, rank=k)
+        return p.dot(q)
+
+    def minimize(self, target):
+        """
+        The best approximation of target at the rank or energy of this approximation, by Eckart-Young.
+        """
+        p, q = self.factorize(target)
+        return p.dot(q)
 
 
 def pca(x):
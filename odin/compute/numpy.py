@@ -5,11 +5,23 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import json
 import logging
+import os
+from functools import partial
+from itertools import islice
+
+import numpy as np
 from progress.bar import ChargingBar
 from scipy import linalg as LA
 
+import odin
+from .activation_store import ActivationStore, sample_indices, split_size, weights_hash
 from .base import ComputationInterface
+from .covariance import CovarianceCheckpoint, accumulator_for, accumulator_options_for, iterate_chunks, \
+    make_accumulator
+from .parallel import accumulate_covariance
+from .spectrum import compress_spectrum, eigen_values as eigen_spectrum
 
 
 # noinspection PyUnresolvedReferences
@@ -128,7 +140,54 @@ class Numpy(ComputationInterface):
             "eigen_values": eigen_values,
         }, group_name="inter_layer_covariance", model_wrapper=model_wrapper)
 
-    def calc_inter_layer_covariance(self, model_wrapper, use_training_data=True, batch_size=100, **options):
+    def _input_chunks(self, data_x, is_chainer, chunk_size):
+        """
+        Yield stacked input batches from a dataset split without materializing the whole split.
+        """
+        for chunk in iterate_chunks(data_x, chunk_size):
+            if is_chainer:
+                chunk = [sample[0] for sample in chunk]
+            yield self.xp.asarray(np.stack(chunk, axis=0))
+
+    def _layer_output_batches(self, model_wrapper, batches):
+        """
+        Run the forward pass for each input batch.
+        """
+        for x in batches:
+            layer_outputs = model_wrapper.get_layer_outputs(x)
+            if model_wrapper.model_type == "chainer":
+                layer_outputs = [layer_out.data for layer_out in layer_outputs]
+            yield layer_outputs
+
+    def calc_inter_layer_covariance(self, model_wrapper, use_training_data=True, batch_size=100,
+                                    accumulation_dtype=None, streaming=False, data_file=None, spectrum="eigvalsh",
+                                    trace_fraction=0.99, activation_cache=False, conv_reduction="flatten",
+                                    max_covariance_mb=1024, parallel=False, covariance_checkpoint_interval=0,
+                                    spectrum_tol=None, **options):
+        """
+        Calculate the covariance matrix and its eigen values for each layer and store them as
+        'inter_layer_covariance'.
+
+        :param model_wrapper:
+        :param use_training_data: Use the training split, otherwise the test split
+        :param batch_size: Number of randomly chosen samples. Ignored when streaming.
+        :param accumulation_dtype: The dtype used when accumulating the covariance
+        :param streaming: Stream the full split in chunks and compute mean centered covariances
+        :param data_file: An optional .npy file with the inputs which is memory mapped when streaming
+        :param spectrum: The eigen solver, see odin.compute.spectrum.methods
+        :param trace_fraction: The fraction of the trace captured by the partial top-k solvers
+        :param activation_cache: Read the layer outputs from an ActivationStore, writing it first if necessary
+        :param conv_reduction: 'flatten' whole convolutional outputs, use a 'channel' covariance where every spatial
+            position is a sample or decide per layer ('auto') from max_covariance_mb
+        :param max_covariance_mb: The memory budget of a flattened covariance matrix in 'auto' mode
+        :param parallel: Shard the samples over 'available_cores' worker processes which each load the saved model
+        :param covariance_checkpoint_interval: Save the accumulators every this many compute batches and resume from
+            a matching checkpoint. Not used in parallel mode.
+        :param spectrum_tol: Also store the spectra compressed with this absolute degree of freedom error as
+            'spectrum_values' and 'spectrum_weights'
+        :param options:
+        :return:
+        """
 
         model = model_wrapper.model
         is_chainer = model_wrapper.model_type == "chainer"
@@ -138,85 +197,150 @@ class Numpy(ComputationInterface):
 
         xp = self.xp
 
-        train, test = model_wrapper.dataset
-
-        data_x = train if use_training_data else test
-
-        if is_chainer:
-            data_x = xp.moveaxis(data_x, -1, 0)[0]
-        else:
-            data_x = data_x[0]
-
-        data_x = xp.stack(data_x, axis=0)
-
-        data_size = len(data_x)
-
-        if batch_size and batch_size > 0:
-            perm = xp.random.permutation(data_size)
-            data_x = data_x[perm[0:batch_size]]
-            data_size = batch_size
-
         compute_batch_size = 100
 
         if is_chainer:
             model.train = False
 
-        # perm = xp.random.permutation(data_size)
-
-        # full_mean = []
-        cov = []
-        test_num = 0
-        bar = ChargingBar("Calculating inter layer covariance", max=data_size)
-        for batch in range(0, data_size, compute_batch_size):
-            test_num += 1
-            # ind_tmp = perm[batch:batch + batch_size] xp.asarray(, dtype=xp.float32)
+        accumulator_options = accumulator_options_for(model_wrapper, streaming=streaming,
+                                                      accumulation_dtype=accumulation_dtype,
+                                                      conv_reduction=conv_reduction,
+                                                      max_covariance_mb=max_covariance_mb)
+        new_accumulator = partial(make_accumulator, xp=xp, **accumulator_options)
+
+        accumulators = []
+        batches = None
+        indices = None
+        if parallel and not activation_cache:
+            if data_file:
+                logging.warning("data_file is ignored by the parallel covariance accumulation")
+            data_size = split_size(model_wrapper, use_training_data)
+            indices = sample_indices(data_size, None if streaming else batch_size, seed=options.get("seed"))
+            num_workers = options.get("available_cores") or odin.config.get("available_cores", 4)
+
+            accumulators = accumulate_covariance(model_wrapper, indices, num_workers,
+                                                 compute_batch_size=compute_batch_size,
+                                                 use_training_data=use_training_data, **accumulator_options)
+            if self.using_gpu:
+                for accumulator in accumulators:
+                    accumulator.xp = xp
+                    accumulator.set_state(accumulator.get_state())
+        elif activation_cache:
+            data_size = split_size(model_wrapper, use_training_data)
+            indices = sample_indices(data_size, None if streaming else batch_size, seed=options.get("seed"))
+            data_size = len(indices)
+
+            store = ActivationStore(model_wrapper, indices, use_training_data=use_training_data,
+                                    compute_batch_size=compute_batch_size)
+            batches = store.batches(compute_batch_size)
+        elif streaming:
+            if data_file:
+                data_x = np.load(data_file, mmap_mode="r")
+                is_chainer_split = False
+            else:
+                train, test = model_wrapper.dataset
+                data_x = train if use_training_data else test
+                is_chainer_split = is_chainer
+                if not is_chainer:
+                    data_x = data_x[0]
+
+            data_size = len(data_x) if hasattr(data_x, "__len__") else 0
+            batches = self._input_chunks(data_x, is_chainer_split, compute_batch_size)
+        else:
+            train, test = model_wrapper.dataset
 
-            x = data_x[batch:batch + compute_batch_size]
+            data_x = train if use_training_data else test
 
-            layer_outputs = model_wrapper.get_layer_outputs(x)
-            for i, layer_out in enumerate(layer_outputs):
-                if is_chainer:
-                    layer_out = layer_out.data
-                # tmp_mean = xp.mean(layer_out, axis=0)
+            if is_chainer:
+                data_x = xp.moveaxis(data_x, -1, 0)[0]
+            else:
+                data_x = data_x[0]
 
-                # tmp_cov = xp.einsum("a,b->ab", layer_out.ravel(), layer_out.ravel())
+            data_x = xp.stack(data_x, axis=0)
 
-                tmp_cov = None
-                for fxi in layer_out:
-                    fxi = fxi.ravel()
-                    dot = xp.outer(fxi, fxi)
-                    if tmp_cov is None:
-                        tmp_cov = dot
-                    else:
-                        tmp_cov += dot
-                    bar.next()
+            data_size = len(data_x)
 
-                if batch == 0:
-                    # full_mean.append(tmp_mean)
-
-                    cov.append(tmp_cov)
+            if batch_size and batch_size > 0:
+                if covariance_checkpoint_interval:
+                    # A reproducible sample set is needed to resume
+                    indices = sample_indices(data_size, batch_size, seed=options.get("seed"))
+                    data_x = data_x[xp.asarray(indices)]
                 else:
-                    # full_mean[i] += tmp_mean
-                    cov[i] += tmp_cov
-            logging.debug("Computed covariance for batch %d of size %d" % (batch, compute_batch_size))
-        bar.finish()
+                    perm = xp.random.permutation(data_size)
+                    data_x = data_x[perm[0:batch_size]]
+                data_size = batch_size
+
+            batches = iterate_chunks(data_x, compute_batch_size)
+
+        checkpoint = None
+        if batches is not None:
+            cursor = 0
+            if covariance_checkpoint_interval:
+                signature = json.dumps({
+                    "weights": weights_hash(model_wrapper),
+                    "use_training_data": use_training_data,
+                    "data_size": data_size,
+                    "data_file": data_file,
+                    "compute_batch_size": compute_batch_size,
+                    "dtype": str(accumulation_dtype),
+                    "streaming": streaming,
+                    "reduction": conv_reduction,
+                    "max_covariance_mb": max_covariance_mb,
+                }, sort_keys=True)
+                checkpoint = CovarianceCheckpoint(os.path.join(model_wrapper.model_path, "covariance_checkpoint"),
+                                                  signature, indices=indices, interval=covariance_checkpoint_interval)
+                cursor, accumulators = checkpoint.load(partial(accumulator_for, xp=xp, **accumulator_options))
+                batches = islice(batches, cursor, None)
+
+            if activation_cache:
+                output_batches = (list(map(xp.asarray, outputs)) for outputs in batches)
+            else:
+                output_batches = self._layer_output_batches(model_wrapper, batches)
+
+            bar = ChargingBar("Calculating inter layer covariance", max=data_size)
+            bar.next(min(cursor * compute_batch_size, data_size))
+            for batch, layer_outputs in enumerate(output_batches, start=cursor):
+                for i, layer_out in enumerate(layer_outputs):
+                    if i == len(accumulators):
+                        accumulators.append(new_accumulator(layer_out))
+                    accumulators[i].update(layer_out)
+                if checkpoint:
+                    checkpoint.maybe_save(batch + 1, accumulators)
+                bar.next(len(layer_outputs[0]))
+                logging.debug("Computed covariance for batch %d of size %d" % (batch, len(layer_outputs[0])))
+            bar.finish()
+
+        cov = [accumulator.covariance() for accumulator in accumulators]
 
         bar = ChargingBar("Calculating eigen values", max=len(cov))
 
         eigen_values = []
         for j in range(len(cov)):
-            cov[j] = cov[j] / test_num
             if self.using_gpu:
                 tmp_cov_ma = self.cuda.to_cpu(cov[j])
             else:
                 tmp_cov_ma = cov[j]
-            eigs = LA.eigvals(tmp_cov_ma)
+            eigs = eigen_spectrum(tmp_cov_ma, method=spectrum, trace_fraction=trace_fraction)
             eigen_values.append(eigs)
             bar.next()
         bar.finish()
 
-        # Saving
-        self.store_elements({
+        elements = {
             "cov": cov,
             "eigen_values": eigen_values,
-        }, group_name="inter_layer_covariance", model_wrapper=model_wrapper)
+        }
+        if conv_reduction != "flatten":
+            elements["channel_wise"] = [accumulator.channel_axis is not None for accumulator in accumulators]
+        if spectrum_tol is not None:
+            compressed = [compress_spectrum(eigs, tol=spectrum_tol) for eigs in eigen_values]
+            elements["spectrum_values"] = [values for values, _ in compressed]
+            elements["spectrum_weights"] = [weights for _, weights in compressed]
+        if streaming:
+            elements["mean"] = [accumulator.mean for accumulator in accumulators]
+            elements["num_samples"] = accumulators[0].num_samples
+
+        # Saving
+        self.store_elements(elements, group_name="inter_layer_covariance", model_wrapper=model_wrapper)
+
+        if checkpoint:
+            checkpoint.clear()
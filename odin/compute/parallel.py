@@ -0,0 +1,229 @@
+"""
+Parallel contains helpers to shard computations over samples across a local process pool.
+Every worker loads the saved model once and the parent merges the partial results.
+"""
+import logging
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import odin
+from .activation_store import split_inputs
+from .covariance import accumulator_for, make_accumulator
+
+_worker_model = None
+_worker_optimizer = None
+_worker_shared_memory = None
+_worker_covariance = None
+
+
+def model_arguments(model_wrapper):
+    """
+    The keyword arguments needed to load the saved model of model_wrapper in another process.
+    """
+    return {key: value for key, value in model_wrapper.args.items() if key not in ("callbacks", "new_model")}
+
+
+def model_key(model_wrapper):
+    """
+    The key of model_wrapper in available_models, which is the name it was loaded with.
+    Wrappers that were constructed directly fall back to their model_name.
+    """
+    return model_wrapper.args.get("model", model_wrapper.model_name)
+
+
+def _init_model_worker(model_name, kwargs):
+    global _worker_model
+    from odin.models import load_model
+    _worker_model = load_model(model_name, **kwargs)
+    if _worker_model.model_type == "chainer":
+        _worker_model.model.train = False
+
+
+def _accumulate_shard(task):
+    batches, use_training_data, accumulator_options = task
+    model_wrapper = _worker_model
+
+    accumulators = None
+    for indices in batches:
+        layer_outputs = model_wrapper.get_layer_outputs(split_inputs(model_wrapper, indices, use_training_data))
+        if model_wrapper.model_type == "chainer":
+            layer_outputs = [layer_out.data for layer_out in layer_outputs]
+        if accumulators is None:
+            accumulators = [make_accumulator(layer_out, **accumulator_options) for layer_out in layer_outputs]
+        for accumulator, layer_out in zip(accumulators, layer_outputs):
+            accumulator.update(layer_out)
+
+    return [(accumulator.channel_axis, accumulator.get_state()) for accumulator in accumulators]
+
+
+def accumulate_covariance(model_wrapper, indices, num_workers, compute_batch_size=100, use_training_data=True,
+                          **accumulator_options):
+    """
+    Accumulate the inter layer covariance statistics of the given samples on a pool of worker processes.
+
+    The compute batches are split into contiguous shards, one per worker, so the merged result is made of exactly
+    the same batches as a serial run.
+
+    :param model_wrapper: The model. Its saved version is loaded by every worker.
+    :param indices: Indices of the samples in the dataset split
+    :param num_workers: The number of processes
+    :param compute_batch_size: The number of samples per forward pass
+    :param use_training_data: Use the training split, otherwise the test split
+    :param accumulator_options: Passed to odin.compute.covariance.make_accumulator
+    :return: A list of merged accumulators, one per layer
+    """
+    batches = [indices[start:start + compute_batch_size] for start in range(0, len(indices), compute_batch_size)]
+    shards = [shard for shard in np.array_split(np.arange(len(batches)), num_workers) if len(shard) > 0]
+    tasks = [([batches[b] for b in shard], use_training_data, accumulator_options) for shard in shards]
+
+    logging.info("Accumulating covariance of %d samples on %d workers" % (len(indices), len(tasks)))
+
+    # Spawn rather than fork since the deep learning frameworks are not fork safe
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(processes=len(tasks), initializer=_init_model_worker,
+                      initargs=(model_key(model_wrapper), model_arguments(model_wrapper))) as pool:
+        results = pool.map(_accumulate_shard, tasks)
+
+    return merge_shard_results(results, **accumulator_options)
+
+
+def merge_shard_results(results, **accumulator_options):
+    """
+    Merge the per layer accumulator states returned by the workers in shard order.
+    :return: A list of accumulators, one per layer
+    """
+    merged = None
+    for shard_result in results:
+        accumulators = [accumulator_for(channel_axis, **accumulator_options).set_state(state)
+                        for channel_axis, state in shard_result]
+        if merged is None:
+            merged = accumulators
+        else:
+            for accumulator, other in zip(merged, accumulators):
+                accumulator.merge(other)
+
+    return merged
+
+
+def _init_sweep_worker(shared_name, shape, widths, num_layers):
+    global _worker_optimizer, _worker_shared_memory
+    from .lambda_param import LambdaOptimizer
+    _worker_shared_memory = shared_memory.SharedMemory(name=shared_name)
+    padded_eigen_values, padded_weights = np.ndarray(shape, dtype=np.float64, buffer=_worker_shared_memory.buf)
+    _worker_optimizer = LambdaOptimizer.from_eigen_values(padded_eigen_values, widths, num_layers, padded_weights)
+
+
+def _solve_rho(task):
+    rho, method, optimize_options = task
+    lambdas, layer_widths = _worker_optimizer.optimize(method=method, rho=rho, **optimize_options)
+    return lambdas, layer_widths, _worker_optimizer.current_result.success
+
+
+def sweep_rho(l_opt, rho_range, num_workers, method="Newton-CG", callback=None, **optimize_options):
+    """
+    Solve the lambda optimization for every rho on a pool of worker processes.
+
+    The padded eigen values and their weights are placed in shared memory once and every worker builds its own optimizer on top of
+    them, so only rho values and results are sent between processes.
+
+    :param l_opt: LambdaOptimizer
+    :param rho_range: The values of rho
+    :param num_workers: The number of processes
+    :param method: The optimization method
+    :param callback: Called as callback(i, lambdas, layer_widths, success) for every result in the order of rho_range
+    :param optimize_options: Passed on to LambdaOptimizer.optimize
+    :return: lambdas, layer_widths and success as arrays in the order of rho_range
+    """
+    padded = np.ascontiguousarray(np.stack([l_opt.padded_eigen_values, l_opt.eigen_weights]), dtype=np.float64)
+    shared = shared_memory.SharedMemory(create=True, size=max(padded.nbytes, 1))
+    try:
+        np.ndarray(padded.shape, dtype=np.float64, buffer=shared.buf)[:] = padded
+
+        tasks = [(rho, method, optimize_options) for rho in rho_range]
+        results = []
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(processes=num_workers, initializer=_init_sweep_worker,
+                          initargs=(shared.name, padded.shape, l_opt.eigen_widths, l_opt.num_layers)) as pool:
+            for i, result in enumerate(pool.imap(_solve_rho, tasks, chunksize=max(1, len(tasks) // (8 * num_workers)))):
+                results.append(result)
+                if callback:
+                    callback(i, *result)
+    finally:
+        shared.close()
+        shared.unlink()
+
+    lambdas, layer_widths, success = zip(*results)
+    return np.array(lambdas), np.array(layer_widths), np.array(success)
+
+
+def _attach_covariance(name, shape):
+    global _worker_covariance
+    if _worker_covariance is None or _worker_covariance[0].name != name:
+        if _worker_covariance is not None:
+            _worker_covariance[0].close()
+        shared = shared_memory.SharedMemory(name=name)
+        _worker_covariance = (shared, np.ndarray(shape, dtype=np.float64, buffer=shared.buf))
+    return _worker_covariance[1]
+
+
+def _score_candidates(task):
+    from .architecture import index_set_objective
+    name, shape, selected, chunk = task
+    cov = _attach_covariance(name, shape)
+    return [index_set_objective(cov, np.union1d(selected, [node])) for node in chunk]
+
+
+class IndexSetPool(object):
+    """
+    A long lived pool of processes scoring the candidates of the greedy index set selection.
+
+    The covariance matrix of the current layer is placed in shared memory and the workers attach to it on their first
+    task, so a step only sends the selected nodes and a chunk of candidates to every worker. The pool is meant to be
+    reused for all layers.
+    """
+
+    def __init__(self, num_workers=None):
+        """
+        :param num_workers: The number of processes. Defaults to 'available_cores'.
+        """
+        self.num_workers = num_workers or odin.config.get("available_cores", 4)
+        self._pool = multiprocessing.get_context("spawn").Pool(processes=self.num_workers)
+        self._shared = None
+        self._shape = None
+
+    def set_covariance(self, cov):
+        """
+        Place the covariance matrix of the next layer in shared memory.
+        """
+        self._release()
+        cov = np.ascontiguousarray(cov, dtype=np.float64)
+        self._shared = shared_memory.SharedMemory(create=True, size=max(cov.nbytes, 1))
+        np.ndarray(cov.shape, dtype=np.float64, buffer=self._shared.buf)[:] = cov
+        self._shape = cov.shape
+
+    def scores(self, selected, choices):
+        """
+        The objective of selected together with each of the choices.
+        """
+        chunks = [chunk for chunk in np.array_split(choices, 4 * self.num_workers) if len(chunk) > 0]
+        tasks = [(self._shared.name, self._shape, selected, chunk) for chunk in chunks]
+        return [value for values in self._pool.map(_score_candidates, tasks) for value in values]
+
+    def _release(self):
+        if self._shared is not None:
+            self._shared.close()
+            self._shared.unlink()
+            self._shared = None
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+        self._release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,155 @@
+"""
+Spectrum contains the solvers used to compute the eigen values of inter layer covariance matrices.
+"""
+import logging
+
+import numpy as np
+import scipy.linalg as LA
+from scipy.sparse.linalg import eigsh
+
+methods = ["eigvals", "eigvalsh", "lanczos", "randomized"]
+
+
+def _lanczos(cov, k, **options):
+    return eigsh(cov, k=k, which="LA", return_eigenvectors=False)
+
+
+def _randomized(cov, k, oversampling=10, power_iterations=2, seed=None, **options):
+    """
+    Randomized range finder (Halko et al.) followed by a dense solve of the projected matrix.
+    """
+    d = cov.shape[0]
+    rng = np.random.RandomState(seed)
+    omega = rng.standard_normal((d, min(d, k + oversampling)))
+    q, _ = LA.qr(cov.dot(omega), mode="economic")
+    for _ in range(power_iterations):
+        q, _ = LA.qr(cov.dot(q), mode="economic")
+    projected = q.T.dot(cov).dot(q)
+    return LA.eigvalsh(projected)[-k:]
+
+
+_partial_solvers = {
+    "lanczos": _lanczos,
+    "randomized": _randomized,
+}
+
+
+def top_eigen_values(cov, trace_fraction=0.99, method="lanczos", initial_k=32, **options):
+    """
+    Compute the largest eigen values of a symmetric positive semi-definite matrix until they capture
+    trace_fraction of its trace. The number of computed eigen values is doubled until the fraction is reached.
+
+    :param cov: symmetric matrix
+    :param trace_fraction: The fraction of the trace the returned eigen values should sum to
+    :param method: 'lanczos' or 'randomized'
+    :param initial_k: The number of eigen values in the first attempt
+    :return: eigen values in descending order
+    """
+    solver = _partial_solvers[method]
+    d = cov.shape[0]
+    target = trace_fraction * np.trace(cov)
+    k = min(initial_k, d)
+
+    while True:
+        if k >= d - 1:
+            eigs = LA.eigvalsh(cov)[::-1]
+        else:
+            eigs = np.sort(solver(cov, k, **options))[::-1]
+
+        captured = np.cumsum(eigs)
+        if captured[-1] >= target or k >= d - 1:
+            n = min(np.searchsorted(captured, target) + 1, len(eigs))
+            logging.debug("Captured %.5f of the trace with %d/%d eigen values" % (
+                captured[n - 1] / max(np.trace(cov), 1e-300), n, d))
+            return eigs[:n]
+
+        k = min(2 * k, d)
+
+
+def eigen_values(cov, method="eigvalsh", trace_fraction=0.99, **options):
+    """
+    Compute the spectrum of a covariance matrix.
+
+    :param cov: symmetric matrix
+    :param method: 'eigvals' for the general solver, 'eigvalsh' for the full symmetric solver and
+        'lanczos' or 'randomized' for the partial top-k solvers
+    :param trace_fraction: Only used by the partial solvers
+    :return: eigen values. Real and in descending order except for 'eigvals'.
+    """
+    if method == "eigvals":
+        return LA.eigvals(cov)
+    elif method == "eigvalsh":
+        return LA.eigvalsh(cov)[::-1]
+    elif method in _partial_solvers:
+        return top_eigen_values(cov, trace_fraction=trace_fraction, method=method, **options)
+    else:
+        raise ValueError("Unknown spectrum method %s" % method)
+
+
+def spectral_dof(values, weights, lambdas):
+    """
+    Degree of freedom sum_k w_k mu_k / (mu_k + lambda) of a weighted spectrum for every lambda.
+    """
+    lambdas = np.atleast_1d(lambdas)
+    return np.sum(weights * values / (values + lambdas[:, None]), axis=1)
+
+
+def _log_bins(eigs, num_bins):
+    """
+    Collapse eigen values into log spaced bins represented by their mean and count.
+    Zero eigen values are kept in a single bin.
+    """
+    positive = eigs[eigs > 0]
+    values = []
+    weights = []
+    if len(positive) > 0:
+        edges = np.logspace(np.log10(positive.min()), np.log10(positive.max()), num_bins + 1)
+        bins = np.clip(np.searchsorted(edges, positive, side="right") - 1, 0, num_bins - 1)
+        counts = np.bincount(bins, minlength=num_bins)
+        sums = np.bincount(bins, weights=positive, minlength=num_bins)
+        occupied = counts > 0
+        values.append(sums[occupied] / counts[occupied])
+        weights.append(counts[occupied])
+    num_zero = len(eigs) - len(positive)
+    if num_zero > 0:
+        values.append(np.zeros(1))
+        weights.append(np.array([num_zero]))
+    return np.concatenate(values), np.concatenate(weights).astype(float)
+
+
+def compress_spectrum(eigs, tol=0.05, num_exact=32, num_bins=32):
+    """
+    Compress a spectrum into its largest eigen values and log spaced bins of the rest, weighted by their counts.
+
+    The number of bins is doubled until the degree of freedom of the compressed spectrum is within tol of the exact one
+    on a log spaced grid of lambda covering the spectrum. Each bin is represented by its mean, which also preserves
+    the limits for small and large lambda.
+
+    :param eigs: eigen values
+    :param tol: The maximal absolute error of the degree of freedom, in neurons
+    :param num_exact: The number of largest eigen values kept exactly
+    :param num_bins: The initial number of bins
+    :return: values, weights
+    """
+    eigs = np.sort(np.abs(eigs))[::-1].astype(float)
+    top, tail = eigs[:num_exact], eigs[num_exact:]
+    exact_weights = np.ones(len(eigs))
+
+    positive = eigs[eigs > 0]
+    if len(tail) == 0 or len(positive) == 0:
+        return eigs, exact_weights
+
+    lambdas = np.logspace(np.log10(positive.min()) - 1, np.log10(positive.max()) + 1, 100)
+    exact = spectral_dof(eigs, exact_weights, lambdas)
+
+    while num_bins < len(tail):
+        tail_values, tail_weights = _log_bins(tail, num_bins)
+        values = np.concatenate([top, tail_values])
+        weights = np.concatenate([np.ones(len(top)), tail_weights])
+        error = np.max(np.abs(spectral_dof(values, weights, lambdas) - exact))
+        if error <= tol:
+            logging.debug("Compressed %d eigen values into %d with error %.5f" % (len(eigs), len(values), error))
+            return values, weights
+        num_bins *= 2
+
+    return eigs, exact_weights
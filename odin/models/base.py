@@ -36,6 +36,7 @@ class ModelWrapper(ABC):
     callback_manager: CallbackManager
 
     def __init__(self, **kwargs):
+        prebuilt_model = kwargs.pop("prebuilt_model", None)
         self.args = kwargs
         self.prefix = kwargs.get('prefix', "default")
         self.verbose = kwargs.get("verbose", False)
@@ -44,7 +45,10 @@ class ModelWrapper(ABC):
         if len(self.dataset) == 4:
             self.x_train, self.y_train, self.x_test, self.y_test = self.dataset
         new_model = kwargs.get("new_model", False)
-        if new_model:
+        if prebuilt_model is not None:
+            self.model = prebuilt_model
+            print("Wrapped model %s" % self)
+        elif new_model:
             self.model = self.construct()
             print("Constructed model %s" % self)
             if self.verbose:
@@ -130,6 +134,42 @@ class ModelWrapper(ABC):
         self.get_group(group)
         return self._elements[group][element_name]
 
+    def narrowed(self, keep, prefix=None):
+        """
+        Wrap a copy of the model where only the kept units of some layers remain.
+        :param keep: dict from the name of an original layer to the indexes of its kept units
+        :param prefix: prefix of the new wrapper. Defaults to the prefix of this wrapper + '_narrow'
+        :return: a new wrapper of the same class
+        """
+        return self._wrap(self.narrowed_model(keep), prefix or self.prefix + "_narrow")
+
+    def factorized(self, factors, prefix=None):
+        """
+        Wrap a copy of the model where the weights of some fully connected layers are replaced by low rank factors.
+        :param factors: dict from the name of an original layer to (P, Q) with W ~ P Q
+        :param prefix: prefix of the new wrapper. Defaults to the prefix of this wrapper + '_factorized'
+        :return: a new wrapper of the same class
+        """
+        return self._wrap(self.factorized_model(factors), prefix or self.prefix + "_factorized")
+
+    def _wrap(self, model, prefix):
+        args = {k: v for k, v in self.args.items() if k != "callbacks"}
+        args["prefix"] = prefix
+        args["prebuilt_model"] = model
+        return self.__class__(**args)
+
+    def narrowed_model(self, keep):
+        raise NotImplementedError("%s can not be narrowed" % self.__class__.__name__)
+
+    def factorized_model(self, factors):
+        raise NotImplementedError("%s can not be factorized" % self.__class__.__name__)
+
+    def predict_batch(self, x):
+        raise NotImplementedError
+
+    def parameter_count(self):
+        raise NotImplementedError
+
     def model_to_dot(self,
                      show_shapes=False,
                      show_layer_names=True,
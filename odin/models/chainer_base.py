@@ -1,6 +1,8 @@
+import copy
 import os
 
 import chainer.serializers
+import numpy as np
 
 from odin.misc.dataset import load_dataset
 from odin.models.base import LayerWrapper, ModelWrapper
@@ -55,6 +57,50 @@ class ChainerModelWrapper(ModelWrapper):
     def get_layer_outputs(self, x):
         return self.model.predictor(x, multi_layer=True)
 
+    def narrowed_model(self, keep):
+        """
+        Copy the model with narrower Linear and Convolution2D links and slice the weights of the links downstream.
+        The links of the predictor are assumed to form a chain.
+        :param keep: dict from link name to the indexes of its kept units
+        :return: chainer model
+        """
+        model = copy.deepcopy(self.model)
+        inputs = None
+        for link in model.predictor.children():
+            W = link.W.array
+            b = link.b.array if link.b is not None else None
+            if inputs is not None:
+                if W.ndim == 2 and W.shape[1] != units:
+                    # The input is a flattened convolution output with the channels first
+                    spatial = W.shape[1] // units
+                    inputs = (inputs[:, None] * spatial + np.arange(spatial)[None, :]).ravel()
+                W = W[:, inputs]
+            units = W.shape[0]
+            inputs = None
+            if link.name in keep:
+                inputs = np.asarray(keep[link.name])
+                W = W[inputs]
+                if b is not None:
+                    b = b[inputs]
+
+            with link.init_scope():
+                link.W = chainer.Parameter(W)
+                if b is not None:
+                    link.b = chainer.Parameter(b)
+            for attribute, size in (("out_size", W.shape[0]), ("out_channels", W.shape[0]),
+                                    ("in_size", W.shape[1]), ("in_channels", W.shape[1])):
+                if hasattr(link, attribute):
+                    setattr(link, attribute, size)
+
+        return model
+
+    def predict_batch(self, x):
+        with chainer.using_config("train", False), chainer.no_backprop_mode():
+            return self.model.predictor(x)
+
+    def parameter_count(self):
+        return sum(param.size for param in self.model.params())
+
     def summary(self):
         return self.model.summary()
 
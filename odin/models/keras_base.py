@@ -1,6 +1,8 @@
 import os
 from abc import ABC
 
+import numpy as np
+
 from odin.misc.dataset import load_dataset
 from odin.models.base import ModelWrapper, LayerWrapper
 import keras.models
@@ -47,6 +49,7 @@ class KerasModelWrapper(ModelWrapper, ABC):
         ]
 
         self._layers = None
+        self._layer_output_function = None
         super(KerasModelWrapper, self).__init__(callbacks=callbacks, **kwargs)
 
         if save_checkpoint:
@@ -61,6 +64,7 @@ class KerasModelWrapper(ModelWrapper, ABC):
 
     def layers(self, force_update=False):
         if force_update or not self._layers:
+            self._layer_output_function = None
             self._layers = []
             for c in self.model.layers:
                 layer = KerasLayer(c)
@@ -86,13 +90,92 @@ class KerasModelWrapper(ModelWrapper, ABC):
         return layer_output
 
     def get_layer_outputs(self, x):
+        """
+        Compute the outputs of all wrapped layers in a single forward pass.
+        The backend function is cached until the layers are updated with layers(force_update=True).
+        :param x: input batch
+        :return: list of layer outputs
+        """
         layers = self.layers()
-        num_layers = len(layers)
-        layer_outputs = []
-        for l in range(num_layers):
-            layer_outputs.append(self.get_nth_layer_output(l, x))
-
-        return layer_outputs
+        if self._layer_output_function is None:
+            self._layer_output_function = backend.function([layers[0].original.input],
+                                                           [layer.original.output for layer in layers])
+
+        return self._layer_output_function([x])
+
+    def narrowed_model(self, keep):
+        """
+        Rebuild the model with narrower Dense and Conv layers and slice the weights of the layers downstream.
+        The layers are assumed to form a chain with the channels last.
+        :param keep: dict from layer name to the indexes of its kept units
+        :return: keras model
+        """
+        from odin.compute.compress import narrow_weights
+
+        layers = self.model.layers
+        positions = {layer.name: n for n, layer in enumerate(layers)}
+        keep = {positions[name]: np.asarray(units) for name, units in keep.items()}
+
+        def clone(layer):
+            config = layer.get_config()
+            n = positions[layer.name]
+            if config.get("data_format") == "channels_first":
+                raise ValueError("Layer %s is channels first" % layer.name)
+            if n in keep:
+                config["units" if "units" in config else "filters"] = len(keep[n])
+            return layer.__class__.from_config(config)
+
+        model = keras.models.clone_model(self.model, clone_function=clone)
+        weights = narrow_weights([(type(layer).__name__, layer.get_weights(), layer.input_shape)
+                                  for layer in layers], keep)
+        for layer, layer_weights in zip(model.layers, weights):
+            layer.set_weights(layer_weights)
+
+        if getattr(self.model, "optimizer", None) is not None:
+            optimizer = self.model.optimizer
+            model.compile(optimizer=optimizer.__class__.from_config(optimizer.get_config()),
+                          loss=self.model.loss)
+        return model
+
+    def factorized_model(self, factors):
+        """
+        Rebuild the model with every factorized Dense layer split into a linear Dense layer with the rank as units and
+        no bias, followed by a Dense layer with the original units, bias and activation.
+        The layers are assumed to form a chain.
+        :param factors: dict from layer name to (P, Q), where the kernel is approximated by P Q
+        :return: keras model
+        """
+        inputs = keras.layers.Input(shape=self.model.input_shape[1:])
+        x = inputs
+        for layer in self.model.layers:
+            if type(layer).__name__ == "InputLayer":
+                continue
+            config = layer.get_config()
+            if layer.name in factors:
+                p, q = factors[layer.name]
+                u = keras.layers.Dense(p.shape[1], use_bias=False, name=layer.name + "_u")
+                config["name"] = layer.name + "_v"
+                v = layer.__class__.from_config(config)
+                x = v(u(x))
+                u.set_weights([p])
+                v.set_weights([q] + layer.get_weights()[1:])
+            else:
+                clone = layer.__class__.from_config(config)
+                x = clone(x)
+                clone.set_weights(layer.get_weights())
+
+        model = keras.models.Model(inputs, x, name=self.model.name + "_factorized")
+        if getattr(self.model, "optimizer", None) is not None:
+            optimizer = self.model.optimizer
+            model.compile(optimizer=optimizer.__class__.from_config(optimizer.get_config()),
+                          loss=self.model.loss)
+        return model
+
+    def predict_batch(self, x):
+        return self.model.predict_on_batch(x)
+
+    def parameter_count(self):
+        return self.model.count_params()
 
     def train(self, **options):
         (x_train, y_train), (_, _) = self.load_dataset()
@@ -90,6 +90,15 @@ def default_arguments_and_behavior():
                     help='Number of words in each mini-batch '
                          '(= length of truncated BPTT)')
 
+    ap.add_argument("--refine", dest="refine", action="store_true",
+                    help="Refine the grid of the lambda path in range_test and calc_dof where the layer widths "
+                         "change. The stored grid is then no longer uniform.")
+
+    ap.add_argument('--lambda_method', type=str, required=False,
+                    choices=["Newton-CG", "trust-ncg", "trust-krylov", "batch"],
+                    help="Second order method used by the lambda optimizer in range_test. 'batch' solves all values "
+                         "of rho at once with a projected Newton iteration")
+
     ap.add_argument('--regularizing', type=str, default="sq", choices=["sq", "abs"],
                     help="Which regularizer to use in lambda optimizer")
 
@@ -97,6 +106,67 @@ def default_arguments_and_behavior():
     ap.add_argument('--primetext', type=str, required=False,
                     help='base text data, used for text generation')
 
+    ap.add_argument('--accumulation_dtype', type=str, required=False, choices=["float32", "float64"],
+                    help="The dtype used when accumulating inter layer covariance")
+
+    ap.add_argument("--streaming", dest="streaming", action="store_true",
+                    help="Stream the full dataset in chunks when computing mean centered covariances")
+    ap.add_argument('--data_file', type=str, required=False,
+                    help="A .npy file with inputs that is memory mapped when streaming")
+
+    ap.add_argument("--activation_cache", "--activation-cache", dest="activation_cache", action="store_true",
+                    help="Store layer activations on disk once and reuse them across actions")
+    ap.add_argument('--spectrum', type=str, required=False, choices=["eigvals", "eigvalsh", "lanczos", "randomized"],
+                    help="Eigen solver for the inter layer covariance spectrum")
+    ap.add_argument('--trace_fraction', type=float, required=False,
+                    help="Fraction of the covariance trace captured by the partial eigen solvers")
+
+    ap.add_argument('--index_set_method', type=str, required=False, choices=["incremental", "greedy", "pivoted_cholesky", "qr"],
+                    help="Selection method of calc_index_set. 'greedy' evaluates every candidate and can use "
+                         "--parallel")
+
+    ap.add_argument('--greedy_mode', type=str, required=False, choices=["plain", "lazy", "stochastic"],
+                    help="Evaluate every candidate, only the top of a heap of stale gains or a random subset in each "
+                         "step of the 'greedy' index set method")
+
+    ap.add_argument("--concurrent_layers", dest="concurrent_layers", action="store_true",
+                    help="Compute the index sets of the layers on --available_cores processes")
+
+    ap.add_argument("--no_index_set_log", dest="no_index_set_log", action="store_true",
+                    help="Do not log the greedy steps of calc_index_set, so it can not be resumed")
+
+    ap.add_argument("--no_reconstruction", dest="no_reconstruction", action="store_true",
+                    help="Only slice the weights in create_compressed_network instead of folding the linear "
+                         "reconstruction of the removed nodes into the next layer")
+
+    ap.add_argument('--compress_method', type=str, required=False, choices=["greedy", "pivoted_cholesky", "group_sparse"],
+                    help="Neuron selection of narrow_network")
+    ap.add_argument('--compress_alpha', type=float, required=False,
+                    help="The variance the neurons removed by narrow_network may leave unexplained")
+    ap.add_argument('--selection_criterion', type=str, required=False,
+                    choices=["trace", "residual_variance", "leverage"],
+                    help="Score of the candidates in each step of the greedy compress method")
+
+    ap.add_argument('--rank', type=int, required=False,
+                    help="Rank of the factors of the fully connected layers in factorize_network")
+    ap.add_argument('--energy', type=float, required=False,
+                    help="Fraction of the squared Frobenius norm of the kernels kept by factorize_network when no "
+                         "--rank is given")
+
+    ap.add_argument('--spectrum_tol', type=float, required=False,
+                    help="Compress the spectra with this absolute error in the degrees of freedom for the "
+                         "lambda optimizer")
+
+    ap.add_argument('--conv_reduction', type=str, required=False, choices=["flatten", "channel", "auto"],
+                    help="How convolutional outputs are reduced before their covariance is computed")
+    ap.add_argument('--max_covariance_mb', type=float, required=False,
+                    help="Memory budget of a flattened covariance matrix when --conv_reduction=auto")
+
+    ap.add_argument('--covariance_checkpoint_interval', type=int, required=False,
+                    help="Save the covariance accumulators every N compute batches so that calc_eigs can resume")
+    ap.add_argument("--parallel", dest="parallel", action="store_true",
+                    help="Shard computations that support it over --available_cores worker processes")
+
     ap.add_argument('--available_cores', type=int, default=4,
                     help='The number of CPU cores that can be used for computation')
 
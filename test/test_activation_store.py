@@ -0,0 +1,61 @@
+import tempfile
+import unittest
+
+import numpy as np
+
+from odin.compute.activation_store import ActivationStore, sample_indices
+from odin.compute.covariance import accumulator_options_for
+
+
+class DenseWrapper(object):
+    """
+    A minimal two layer model wrapper that counts its forward passes.
+    """
+    model_type = "keras"
+
+    def __init__(self, model_path):
+        self.model_path = model_path
+        self.w = [np.random.standard_normal((6, 8)), np.random.standard_normal((8, 3))]
+        self.dataset = ((np.random.standard_normal((230, 6)), None), (np.random.standard_normal((50, 6)), None))
+        self.forward_passes = 0
+
+    def weights(self):
+        return self.w
+
+    def get_layer_outputs(self, x):
+        self.forward_passes += 1
+        h = np.maximum(x.dot(self.w[0]), 0)
+        return [h, h.dot(self.w[1])]
+
+
+class TestActivationStore(unittest.TestCase):
+
+    def test_store_is_reused(self):
+        with tempfile.TemporaryDirectory() as model_path:
+            wrapper = DenseWrapper(model_path)
+            indices = sample_indices(230, 150, seed=0)
+
+            layers = ActivationStore(wrapper, indices).load()
+            self.assertEqual(wrapper.forward_passes, 2)
+            self.assertEqual(layers[1].shape, (150, 3))
+            np.testing.assert_allclose(layers[1], wrapper.get_layer_outputs(wrapper.dataset[0][0][indices])[1])
+
+            passes = wrapper.forward_passes
+            ActivationStore(wrapper, indices).load()
+            self.assertEqual(wrapper.forward_passes, passes)
+
+            wrapper.w[0] = wrapper.w[0] * 2
+            self.assertFalse(ActivationStore(wrapper, indices).complete)
+
+    def test_layer_covariances_follow_the_calc_eigs_settings(self):
+        with tempfile.TemporaryDirectory() as model_path:
+            wrapper = DenseWrapper(model_path)
+            wrapper.get_layer_outputs = lambda x: [np.tanh(x.reshape(len(x), 3, 2)), x.dot(wrapper.w[0])]
+            store = ActivationStore(wrapper, np.arange(230))
+            options = accumulator_options_for(wrapper, streaming=True, conv_reduction="channel")
+
+            channel_cov, dense_cov = store.layer_covariances(**options)
+            outputs = store.load()
+            self.assertEqual(channel_cov.shape, (2, 2))
+            np.testing.assert_allclose(channel_cov, np.cov(outputs[0].reshape(-1, 2).T), atol=1e-10)
+            np.testing.assert_allclose(dense_cov, np.cov(outputs[1].T), atol=1e-10)
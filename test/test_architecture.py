@@ -1,11 +1,72 @@
-from odin.compute.architecture import greedy
+import os
+import shutil
+import tempfile
+import unittest
+
 import numpy as np
 
-import unittest
+from odin.compute.architecture import IndexSetLog, SchurComplement, calculate_index_set, compare_index_set_methods, \
+    compute_index_set, greedy, index_set_objective, index_set_quality, pivoted_cholesky, transfer_to_architecture
+
+
+class Layer(object):
+    type = "fully_connected"
+    biases = None
+
+    def __init__(self, units, weights=None, biases=None):
+        self.units = units
+        self.weights = weights
+        self.biases = biases
+
+
+class IndexSetWrapper(object):
+    """
+    Collects the stored index sets of a model with the given layer widths.
+    """
+
+    def __init__(self, widths, model_path):
+        self.widths = widths
+        self.model_path = model_path
+        self.index_set = {}
+
+    def layers(self):
+        return [Layer(w) for w in self.widths]
+
+    def put_group(self, group, elements):
+        self.index_set.update(elements)
+
+
+class LinearWrapper(object):
+    """
+    An affine network with stored index sets, constructed like the model wrappers.
+    """
+    prefix = "linear"
+
+    def __init__(self, weights, index_set=None, biases=None, **kwargs):
+        self.weights = weights
+        self.biases = biases or [np.zeros(w.shape[1]) for w in weights]
+        self.index_set = index_set
+
+    def layers(self):
+        return [Layer(w.shape[1], w, b) for w, b in zip(self.weights, self.biases)]
+
+    def get_group(self, group):
+        return self.index_set
+
+    def predict(self, x):
+        for w, b in zip(self.weights, self.biases):
+            x = x.dot(w) + b
+        return x
 
 
 class TestArchitecture(unittest.TestCase):
 
+    def setUp(self):
+        self.model_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.model_path)
+
     def test_greedy(self):
         scores = np.random.random_integers(0, 100, 100)
 
@@ -23,4 +84,157 @@ class TestArchitecture(unittest.TestCase):
         selected = greedy(constraint=simple_constraint, indexes=indexes, m_l=m_l, parallel=True)
         self.assertEqual(m_l, len(selected))
 
+    def test_schur_complement(self):
+        x = np.random.RandomState(0).standard_normal((200, 10))
+        cov = x.T.dot(x) / 200
+        schur = SchurComplement(cov)
+        for c in [3, 7]:
+            schur.add(c)
+        block = SchurComplement(cov)
+        block.add_block(np.array([3, 7]), cov)
+
+        np.testing.assert_allclose(schur.residual, block.residual, atol=1e-12)
+        np.testing.assert_allclose(schur.column_norms, np.sum(schur.residual ** 2, axis=0), atol=1e-12)
+        gain, independent = schur.gains()
+        self.assertFalse(independent[3] or independent[7])
+        np.testing.assert_allclose(gain[independent], block.gains()[0][independent])
+
+    def test_incremental_greedy(self):
+        x = np.random.standard_normal((200, 40)) * np.exp(-np.arange(40) / 15.0)
+        cov = x.T.dot(x) / 200
+
+        expected = compute_index_set(0, cov, 15, 40, None, method="greedy")
+        j = compute_index_set(0, cov, 15, 40, None, method="incremental")
+        np.testing.assert_array_equal(j, expected)
+
+    def test_lazy_and_stochastic_greedy(self):
+        scores = np.random.random(100)
+
+        def additive_constraint(j):
+            return np.sum(scores[list(map(int, j))])
+
+        indexes = np.arange(100)
+        expected = greedy(additive_constraint, indexes, 20, mode="plain")
+        evaluations, plain_evaluations = greedy.evaluations
+        self.assertEqual(evaluations, plain_evaluations)
+
+        selected = greedy(additive_constraint, indexes, 20, mode="lazy")
+        np.testing.assert_array_equal(selected, expected)
+        self.assertLess(greedy.evaluations[0], plain_evaluations)
+
+        selected = greedy(additive_constraint, indexes, 20, mode="stochastic", seed=0)
+        self.assertEqual(len(np.unique(selected)), 20)
+        self.assertLess(greedy.evaluations[0], plain_evaluations)
+
+    def test_concurrent_layers(self):
+        widths = [20, 50, 30]
+        cov_list = []
+        for d in widths:
+            x = np.random.standard_normal((100, d))
+            cov_list.append(x.T.dot(x) / 100)
+
+        serial = IndexSetWrapper(widths, self.model_path)
+        calculate_index_set(serial, [5, 10, 8], cov_list, resume=False)
+        concurrent = IndexSetWrapper(widths, self.model_path)
+        calculate_index_set(concurrent, [5, 10, 8], cov_list, concurrent_layers=True)
+
+        self.assertEqual(sorted(serial.index_set.keys()), ["layer_0", "layer_1", "layer_2"])
+        for key, j in serial.index_set.items():
+            np.testing.assert_array_equal(concurrent.index_set[key], j)
+
+    def test_pivoted_selection(self):
+        x = np.random.standard_normal((200, 40)) * np.exp(-np.arange(40) / 15.0)
+        cov = x.T.dot(x) / 200
+
+        pivots, residual_traces = pivoted_cholesky(cov, 10)
+        self.assertEqual(pivots[0], np.argmax(np.diag(cov)))
+        self.assertTrue(np.all(np.diff(residual_traces) <= 1e-12))
+        j = pivots[:5]
+        schur = cov - cov[:, j].dot(np.linalg.solve(cov[np.ix_(j, j)], cov[j, :]))
+        self.assertAlmostEqual(residual_traces[4], np.trace(schur))
+
+        self.assertAlmostEqual(index_set_quality(cov, j), index_set_objective(cov, j))
+        for method, quality, elapsed_time in compare_index_set_methods(cov, 10):
+            self.assertTrue(0 < quality < 1)
+
+    def test_resume_from_log(self):
+        x = np.random.standard_normal((200, 40)) * np.exp(-np.arange(40) / 15.0)
+        cov = x.T.dot(x) / 200
+        path = os.path.join(self.model_path, "index_set", "layer_0.log")
+
+        for method in ["incremental", "greedy"]:
+            expected = compute_index_set(0, cov, 12, 40, None, method=method)
+
+            log = IndexSetLog(path, cov, method)
+            compute_index_set(0, cov, 5, 40, None, method=method, log=log)
+            log.close()
+            with open(path, "a") as f:
+                f.write("17 0.3")  # interrupted write
+
+            log = IndexSetLog(path, cov, method)
+            self.assertEqual(len(log), 5)
+            j = compute_index_set(0, cov, 12, 40, None, method=method, log=log)
+            log.close()
+            np.testing.assert_array_equal(j, expected)
+
+            log = IndexSetLog(path, cov, method)
+            self.assertEqual(len(log.scores), 12)
+            np.testing.assert_array_equal(compute_index_set(0, cov, 8, 40, None, method=method, log=log),
+                                          np.sort(log.selected[:8]))
+            log.close()
+
+        # The resumed lazy steps log the same scores as an uninterrupted run
+        x = np.random.RandomState(1).standard_normal((200, 40)) * np.exp(-np.arange(40) / 15.0)
+        cov = x.T.dot(x) / 200
+        expected_log = IndexSetLog(os.path.join(self.model_path, "lazy.log"), cov, "greedy")
+        compute_index_set(0, cov, 6, 40, None, method="greedy", greedy_mode="lazy", log=expected_log)
+        expected_log.close()
+
+        os.remove(path)
+        log = IndexSetLog(path, cov, "greedy")
+        compute_index_set(0, cov, 3, 40, None, method="greedy", greedy_mode="lazy", log=log)
+        log.close()
+        log = IndexSetLog(path, cov, "greedy")
+        compute_index_set(0, cov, 6, 40, None, method="greedy", greedy_mode="lazy", log=log)
+        log.close()
+        # Resumed lazy steps start from exact gains, so they may choose differently once the stale gains diverge
+        np.testing.assert_array_equal(log.selected[:4], expected_log.selected[:4])
+        np.testing.assert_allclose(log.scores[:4], expected_log.scores[:4])
+        np.testing.assert_allclose(log.scores, [index_set_objective(cov, log.selected[:k + 1]) for k in range(6)])
+
+    def test_transfer_with_reconstruction(self):
+        # The outputs of the first layer have rank 4, so 4 of its 8 nodes reconstruct the others exactly
+        rng = np.random.RandomState(0)
+        weights = [rng.standard_normal((4, 8)), rng.standard_normal((8, 6)), rng.standard_normal((6, 2))]
+        model = LinearWrapper(weights)
+        x = rng.standard_normal((500, 4))
+        h1 = x.dot(weights[0])
+        h2 = h1.dot(weights[1])
+        cov_list = [h1.T.dot(h1) / 500, h2.T.dot(h2) / 500]
+        model.index_set = {"layer_0": compute_index_set(0, cov_list[0], 4, 8, None),
+                           "layer_1": np.arange(6)}
+
+        compressed = transfer_to_architecture(model, cov_list, regularizer_w=1e-12)
+        self.assertEqual([w.shape for w in compressed.weights], [(4, 4), (4, 6), (6, 2)])
+        np.testing.assert_allclose(compressed.predict(x), model.predict(x), rtol=1e-5, atol=1e-8)
+
+        sliced = transfer_to_architecture(model, cov_list, reconstruct=False)
+        self.assertGreater(np.abs(sliced.predict(x) - model.predict(x)).max(), 1e-3)
+
+    def test_transfer_with_centered_covariance(self):
+        # Centered covariances leave out the means, which come back as an intercept in the next bias
+        rng = np.random.RandomState(0)
+        weights = [rng.standard_normal((4, 8)), rng.standard_normal((8, 6)), rng.standard_normal((6, 2))]
+        biases = [rng.standard_normal(8) + 3, rng.standard_normal(6), rng.standard_normal(2)]
+        model = LinearWrapper(weights, biases=biases)
+        x = rng.standard_normal((500, 4))
+        h1 = x.dot(weights[0]) + biases[0]
+        h2 = h1.dot(weights[1]) + biases[1]
+        mean_list = [h1.mean(axis=0), h2.mean(axis=0)]
+        cov_list = [np.cov(h1.T, bias=True), np.cov(h2.T, bias=True)]
+        model.index_set = {"layer_0": compute_index_set(0, cov_list[0], 4, 8, None),
+                           "layer_1": np.arange(6)}
 
+        compressed = transfer_to_architecture(model, cov_list, regularizer_w=1e-12, mean_list=mean_list)
+        self.assertEqual([b.shape for b in compressed.biases], [(4,), (6,), (2,)])
+        np.testing.assert_allclose(compressed.predict(x), model.predict(x), rtol=1e-5, atol=1e-6)
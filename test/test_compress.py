@@ -0,0 +1,203 @@
+import unittest
+
+import numpy as np
+
+from odin.compute.compress import CovarianceOptimizer, _greedy, _group_sparse, _group_sparse_selection, \
+    group_sparse_path, narrow_weights, selection_criteria
+
+
+def _forward(weights, x, masks=None):
+    """
+    Forward pass of conv(1x1) -> Flatten -> Dense -> BatchNormalization -> Dense in the keras layout.
+    The contributions of the units in masks to the next layer are removed.
+    """
+    masks = masks or {}
+    (kernel, bias), _, (w1, b1), (gamma, beta, mean, var), (w2, b2) = weights
+    h = np.maximum(np.einsum("bhwc,co->bhwo", x, kernel[0, 0]) + bias, 0) * masks.get(0, 1)
+    h = h.reshape(len(x), -1)
+    h = np.maximum(h.dot(w1) + b1, 0)
+    h = (gamma * (h - mean) / np.sqrt(var + 1e-3) + beta) * masks.get(2, 1)
+    return h.dot(w2) + b2
+
+
+class TestNarrowWeights(unittest.TestCase):
+
+    def test_sliced_chain_matches_zeroed_units(self):
+        rng = np.random.RandomState(0)
+        channels, spatial, units = 5, (3, 2), 6
+        weights = [
+            [rng.randn(1, 1, 2, channels), rng.randn(channels)],
+            [],
+            [rng.randn(spatial[0] * spatial[1] * channels, units), rng.randn(units)],
+            [rng.rand(units) + 0.5, rng.randn(units), rng.randn(units), rng.rand(units) + 0.5],
+            [rng.randn(units, 3), rng.randn(3)],
+        ]
+        layers = list(zip(["Conv2D", "Flatten", "Dense", "BatchNormalization", "Dense"], weights,
+                          [(None,) + spatial + (2,), (None,) + spatial + (channels,), (None, 30), (None, units),
+                           (None, units)]))
+        keep = {0: [0, 2, 3], 2: [1, 4, 5]}
+
+        sliced = narrow_weights(layers, keep)
+
+        self.assertEqual(sliced[0][0].shape, (1, 1, 2, 3))
+        self.assertEqual(sliced[2][0].shape, (spatial[0] * spatial[1] * 3, 3))
+        self.assertEqual([w.shape for w in sliced[3]], [(3,)] * 4)
+        self.assertEqual(sliced[4][0].shape, (3, 3))
+
+        x = rng.randn(4, spatial[0], spatial[1], 2)
+        masks = {n: np.isin(np.arange(len(weights[n][1])), kept) for n, kept in keep.items()}
+        np.testing.assert_allclose(_forward(sliced, x), _forward(weights, x, masks), rtol=1e-10)
+
+    def test_unknown_layer_after_compression(self):
+        layers = [("Dense", [np.ones((2, 3))], (None, 2)), ("Reshape", [], (None, 3))]
+        self.assertRaises(ValueError, narrow_weights, layers, {0: [0, 1]})
+
+
+class Original(object):
+
+    def __init__(self, name, weights, input_shape):
+        self.name = name
+        self.weights = weights
+        self.input_shape = input_shape
+
+
+class Dense(Original):
+    pass
+
+
+class Conv2D(Original):
+    pass
+
+
+class Flatten(Original):
+    pass
+
+
+class Layer(object):
+    layer_types = {"Dense": "fully_connected", "Conv2D": "convolution"}
+
+    def __init__(self, original):
+        self.original = original
+        self.type = self.layer_types[type(original).__name__]
+        self.units = original.weights[0].shape[-1]
+
+
+class ChainWrapper(object):
+    """
+    A chain of keras style layers that narrows its weights with narrow_weights.
+    """
+
+    def __init__(self, chain, cov_list):
+        self.chain = chain
+        self._layers = [Layer(original) for original in chain if type(original).__name__ in Layer.layer_types]
+        self.cov_list = cov_list
+
+    def layers(self):
+        return self._layers
+
+    def get_element(self, group, element_name):
+        return self.cov_list
+
+    def narrowed(self, keep):
+        positions = {original.name: n for n, original in enumerate(self.chain)}
+        return narrow_weights([(type(original).__name__, original.weights, original.input_shape)
+                               for original in self.chain],
+                              {positions[name]: units for name, units in keep.items()})
+
+
+def _low_rank_covariance(rng, width):
+    factors = rng.randn(width, 3)
+    return factors.dot(factors.T)
+
+
+class TestCovarianceOptimizer(unittest.TestCase):
+
+    def test_output_width_is_kept(self):
+        rng = np.random.RandomState(1)
+        widths = [8, 20, 20, 10]
+        chain = [Dense("d%d" % n, [rng.randn(m, k), rng.randn(k)], (None, m))
+                 for n, (m, k) in enumerate(zip(widths[:-1], widths[1:]))]
+        model_wrapper = ChainWrapper(chain, [_low_rank_covariance(rng, width) for width in widths[1:]])
+
+        result, weights = CovarianceOptimizer(model_wrapper).compress(alpha=5.0, narrow=True)
+
+        self.assertEqual(len(result), 2)
+        self.assertLess(weights[0][0].shape[1], 20)
+        self.assertEqual(weights[-1][0].shape[1], 10)
+        self.assertEqual(weights[-1][1].shape, (10,))
+
+    def test_flattened_conv_covariance_is_skipped(self):
+        rng = np.random.RandomState(2)
+        chain = [Conv2D("conv", [rng.randn(3, 3, 1, 3), rng.randn(3)], (None, 4, 4, 1)),
+                 Flatten("flatten", [], (None, 4, 4, 3)),
+                 Dense("d", [rng.randn(48, 20), rng.randn(20)], (None, 48)),
+                 Dense("out", [rng.randn(20, 10), rng.randn(10)], (None, 20))]
+        cov_list = [_low_rank_covariance(rng, 48), _low_rank_covariance(rng, 20), _low_rank_covariance(rng, 10)]
+        model_wrapper = ChainWrapper(chain, cov_list)
+
+        result, weights = CovarianceOptimizer(model_wrapper).compress(alpha=5.0, narrow=True)
+
+        self.assertEqual(len(result), 1)
+        self.assertEqual(weights[0][0].shape, (3, 3, 1, 3))
+        self.assertEqual(weights[2][0].shape[0], 48)
+        self.assertLess(weights[2][0].shape[1], 20)
+
+
+class TestGreedySelection(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        factors = rng.randn(40, 6) * np.logspace(0, -2, 6)
+        self.cov = factors.dot(factors.T) + np.diag(rng.rand(40) * 1e-3)
+
+    def test_trace_criterion_keeps_largest_variances(self):
+        alpha = 0.1 * np.trace(self.cov)
+        neurons, excluded = _greedy(self.cov, alpha, criterion="trace")
+
+        diagonal = np.diag(self.cov)
+        self.assertEqual(sorted(neurons + excluded), list(range(40)))
+        self.assertGreaterEqual(np.min(diagonal[neurons]), np.max(diagonal[excluded]))
+        self.assertLessEqual(np.sum(diagonal[excluded]), alpha)
+
+    def test_residual_criteria_explain_the_covariance(self):
+        alpha = 0.05
+        for criterion in ("residual_variance", "leverage"):
+            neurons, excluded = _greedy(self.cov, alpha, criterion=criterion)
+            explained = self.cov[:, neurons].dot(np.linalg.solve(self.cov[np.ix_(neurons, neurons)],
+                                                                 self.cov[neurons, :]))
+            self.assertLessEqual(np.trace(self.cov - explained), alpha + 1e-8, criterion)
+            self.assertLess(len(neurons), 20, criterion)
+        self.assertEqual(sorted(selection_criteria), ["leverage", "residual_variance", "trace"])
+
+
+class TestGroupSparse(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        factors = rng.randn(30, 4)
+        self.cov = factors.dot(factors.T) + np.diag(rng.rand(30) * 1e-2)
+
+    def test_optimality(self):
+        lmb = 1.0
+        A = _group_sparse(self.cov, lmb, tol=1e-10)
+        gradient = 2 * (A.dot(self.cov) - self.cov)
+        norms = np.linalg.norm(A, axis=0)
+        active = norms > 0
+
+        self.assertTrue(np.any(~active))
+        np.testing.assert_allclose(gradient[:, active], -lmb * A[:, active] / norms[active], atol=1e-4)
+        self.assertTrue(np.all(np.linalg.norm(gradient[:, ~active], axis=0) <= lmb + 1e-4))
+
+    def test_path_and_selection(self):
+        supports = [np.sum(np.linalg.norm(A, axis=0) > 0) for _, A in group_sparse_path(self.cov, num=8)]
+        self.assertEqual(supports[0], 0)
+        self.assertGreater(supports[-1], 4)
+
+        neurons, excluded = _group_sparse_selection(self.cov, alpha=0.1)
+        self.assertEqual(sorted(neurons + excluded), list(range(30)))
+        explained = self.cov[:, neurons].dot(np.linalg.pinv(self.cov[np.ix_(neurons, neurons)])).dot(self.cov[neurons])
+        self.assertLessEqual(np.trace(self.cov - explained), 0.1)
+
+
+if __name__ == '__main__':
+    unittest.main()
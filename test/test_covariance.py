@@ -0,0 +1,96 @@
+import tempfile
+import unittest
+
+import numpy as np
+
+from odin.compute.covariance import CovarianceAccumulator, CovarianceCheckpoint, StreamingCovarianceAccumulator, \
+    accumulator_for, channel_axis_for, iterate_chunks, outer_product_loop
+
+
+class TestCovariance(unittest.TestCase):
+
+    def test_batched_matches_loop(self):
+        x = np.random.standard_normal((250, 4, 5))
+
+        accumulator = CovarianceAccumulator()
+        for batch in range(0, len(x), 100):
+            accumulator.update(x[batch:batch + 100])
+
+        self.assertEqual(accumulator.num_batches, 3)
+        self.assertEqual(accumulator.num_samples, 250)
+        np.testing.assert_allclose(accumulator.outer_sum, outer_product_loop(x))
+        np.testing.assert_allclose(accumulator.covariance(), outer_product_loop(x) / 3)
+
+    def test_accumulation_dtype(self):
+        x = np.random.standard_normal((10, 6)).astype(np.float32)
+        accumulator = CovarianceAccumulator(dtype=np.float64).update(x)
+        self.assertEqual(accumulator.outer_sum.dtype, np.float64)
+
+    def test_streaming_matches_centered_covariance(self):
+        x = np.random.standard_normal((1000, 7)) * 10 + 1000
+
+        accumulator = StreamingCovarianceAccumulator()
+        for chunk in iterate_chunks(x, 64):
+            accumulator.update(chunk)
+
+        self.assertEqual(accumulator.num_samples, 1000)
+        np.testing.assert_allclose(accumulator.mean, x.mean(axis=0))
+        np.testing.assert_allclose(accumulator.covariance(), np.cov(x, rowvar=False))
+
+    def test_streaming_merge(self):
+        x = np.random.standard_normal((300, 5))
+        left = StreamingCovarianceAccumulator().update(x[:120])
+        right = StreamingCovarianceAccumulator().update(x[120:200]).update(x[200:])
+
+        left.merge(right)
+        np.testing.assert_allclose(left.covariance(), np.cov(x, rowvar=False))
+
+    def test_iterate_chunks_from_generator(self):
+        chunks = list(iterate_chunks((np.ones((3, 2)) for _ in range(4)), 100))
+        self.assertEqual(len(chunks), 4)
+
+    def test_channel_covariance(self):
+        x = np.random.standard_normal((20, 6, 5, 3))
+
+        accumulator = CovarianceAccumulator(channel_axis=-1).update(x)
+        self.assertEqual(accumulator.outer_sum.shape, (3, 3))
+        self.assertEqual(accumulator.num_samples, 20 * 6 * 5)
+        positions = x.reshape(-1, 3)
+        np.testing.assert_allclose(accumulator.outer_sum, positions.T.dot(positions))
+
+        channels_first = np.moveaxis(x, -1, 1)
+        accumulator = StreamingCovarianceAccumulator(channel_axis=1).update(channels_first)
+        np.testing.assert_allclose(accumulator.covariance(), np.cov(positions, rowvar=False))
+
+    def test_auto_reduction(self):
+        x = np.zeros((2, 32, 32, 16), dtype=np.float32)
+        self.assertIsNone(channel_axis_for(x, reduction="auto", max_covariance_mb=1024))
+        self.assertEqual(channel_axis_for(x, reduction="auto", max_covariance_mb=1), -1)
+        self.assertIsNone(channel_axis_for(np.zeros((2, 10)), reduction="channel"))
+
+    def test_checkpoint_resume_is_bit_identical(self):
+        x = np.random.standard_normal((500, 6)).astype(np.float32)
+        batches = [x[start:start + 100] for start in range(0, 500, 100)]
+
+        for streaming in [False, True]:
+            expected = accumulator_for(None, streaming=streaming)
+            for batch in batches:
+                expected.update(batch)
+
+            with tempfile.TemporaryDirectory() as path:
+                checkpoint = CovarianceCheckpoint(path, "signature", indices=np.arange(500), interval=2)
+                interrupted = accumulator_for(None, streaming=streaming)
+                for cursor, batch in enumerate(batches[:3], start=1):
+                    interrupted.update(batch)
+                    checkpoint.maybe_save(cursor, [interrupted])
+
+                cursor, (resumed,) = checkpoint.load(lambda channel_axis: accumulator_for(channel_axis,
+                                                                                          streaming=streaming))
+                self.assertEqual(cursor, 2)
+                for batch in batches[cursor:]:
+                    resumed.update(batch)
+
+                self.assertTrue(np.array_equal(resumed.covariance(), expected.covariance()))
+
+                other = CovarianceCheckpoint(path, "other signature", indices=np.arange(500))
+                self.assertEqual(other.load(accumulator_for), (0, []))
@@ -0,0 +1,116 @@
+import unittest
+
+import numpy as np
+from scipy.optimize import approx_fprime
+
+from odin.compute import parallel
+from odin.compute.lambda_param import LambdaOptimizer
+
+
+class Layer(object):
+    def __init__(self, units):
+        self.units = units
+
+
+class SpectrumWrapper(object):
+    """
+    Provides stored eigen values for a network with the given layer widths.
+    """
+    model = None
+    model_name = "spectrum"
+
+    def __init__(self, widths):
+        self.widths = widths
+        self.eigen_values = [np.sort(np.random.exponential(size=w))[::-1] for w in widths]
+
+    def get_group(self, group):
+        return {"eigen_values": self.eigen_values}
+
+    def get_element(self, group, element_name):
+        return self.eigen_values
+
+    def layers(self):
+        return [Layer(w) for w in self.widths]
+
+
+class TestLambdaOptimizer(unittest.TestCase):
+
+    def setUp(self):
+        self.l_opt = LambdaOptimizer(SpectrumWrapper([30, 50, 20, 40, 10]))
+        self.lamb = np.array([0.1, 0.5, 0.05, 1.0])
+
+    def test_degrees_of_freedom(self):
+        expected = [self.l_opt.degree_of_freedom(lamb, layer) for layer, lamb in enumerate(self.lamb)]
+        np.testing.assert_allclose(self.l_opt.degrees_of_freedom(self.lamb), expected)
+
+        expected_objective = sum(expected[l] * expected[l - 1] for l in range(1, len(expected)))
+        self.assertAlmostEqual(self.l_opt.objective_function(self.lamb), expected_objective)
+
+    def test_derivatives(self):
+        numerical = approx_fprime(self.lamb, self.l_opt.objective_function, 1e-7)
+        np.testing.assert_allclose(self.l_opt.jacobian(self.lamb), numerical, rtol=1e-4)
+
+        p = np.array([1.0, -2.0, 0.5, 3.0])
+        numerical = (self.l_opt.jacobian(self.lamb + 1e-6 * p) - self.l_opt.jacobian(self.lamb - 1e-6 * p)) / 2e-6
+        np.testing.assert_allclose(self.l_opt.hessian_vector_product(self.lamb, p), numerical, rtol=1e-4)
+
+    def test_batched_evaluation(self):
+        lambs = np.stack([self.lamb, 2 * self.lamb])
+        np.testing.assert_allclose(self.l_opt.degrees_of_freedom(lambs)[1],
+                                   self.l_opt.degrees_of_freedom(2 * self.lamb))
+
+    def test_compressed_spectrum(self):
+        wrapper = SpectrumWrapper([3000, 5000, 2000])
+        l_opt = LambdaOptimizer(wrapper, spectrum_tol=0.05)
+        self.assertLess(l_opt.padded_eigen_values.shape[1], 5000)
+
+        exact = LambdaOptimizer(wrapper)
+        lamb = np.array([0.01, 0.5])
+        np.testing.assert_allclose(l_opt.degrees_of_freedom(lamb), exact.degrees_of_freedom(lamb), atol=0.05)
+        np.testing.assert_allclose(l_opt.jacobian(lamb), exact.jacobian(lamb), rtol=1e-3)
+
+    def test_batch_solve(self):
+        rho_range = np.linspace(0.01, 0.15, num=50)
+        lambdas, layer_widths, success = self.l_opt.optimize_batch(rho_range, coarse_size=10)
+        self.assertTrue(np.all(success))
+
+        _, path_lambdas, path_widths, _ = self.l_opt.lambda_path(rho_range, refine=False)
+
+        def lagrangian(l):
+            return self.l_opt.objective_function_batch(l) + rho_range * np.sum(l, axis=1)
+
+        np.testing.assert_allclose(lagrangian(lambdas), lagrangian(path_lambdas), rtol=1e-6)
+        np.testing.assert_allclose(self.l_opt.hessian(self.lamb).dot(self.lamb),
+                                   self.l_opt.hessian_vector_product(self.lamb, self.lamb))
+
+    def test_lambda_path(self):
+        rho_range = np.linspace(0.01, 0.15, num=8)
+        grid, lambdas, layer_widths, success = self.l_opt.lambda_path(rho_range[::-1], min_step=1e-3)
+
+        self.assertTrue(np.all(np.diff(grid) > 0))
+        self.assertGreaterEqual(len(grid), len(rho_range))
+        self.assertEqual(lambdas.shape, (len(grid), self.l_opt.num_layers))
+        for left, right, width_left, width_right in zip(grid[:-1], grid[1:], layer_widths[:-1], layer_widths[1:]):
+            if np.any(width_left != width_right):
+                self.assertLessEqual(right - left, 1e-3 * 2)
+
+        lambdas, layer_widths, success = self.l_opt.range_lambda_dof(rho_range[::-1], method="Newton-CG")
+        self.assertEqual(len(lambdas), len(rho_range))
+
+    def test_parallel_sweep(self):
+        rho_range = np.linspace(0.01, 0.15, num=12)
+        seen = []
+        lambdas, layer_widths, success = parallel.sweep_rho(self.l_opt, rho_range, 2,
+                                                            callback=lambda i, *result: seen.append(i))
+
+        self.assertEqual(seen, list(range(12)))
+        for rho, expected_lambdas, expected_widths in zip(rho_range, lambdas, layer_widths):
+            np.testing.assert_allclose(self.l_opt.optimize(method="Newton-CG", rho=rho)[0], expected_lambdas)
+
+    def test_second_order_methods(self):
+        lambdas, layer_widths = self.l_opt.optimize(method="Newton-CG", rho=0.05)
+        self.assertTrue(self.l_opt.current_result.success)
+        for method in ["trust-ncg", "trust-krylov"]:
+            other_lambdas, other_widths = self.l_opt.optimize(method=method, rho=0.05)
+            self.assertTrue(self.l_opt.current_result.success)
+            np.testing.assert_allclose(other_lambdas, lambdas, rtol=1e-3, atol=1e-6)
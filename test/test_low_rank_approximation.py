@@ -0,0 +1,39 @@
+import unittest
+
+import numpy as np
+
+from odin.compute.low_rank_approximation import LowRankApproximation, dense_flops, factorize, is_worth_factorizing
+
+
+class TestLowRankApproximation(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        u, _ = np.linalg.qr(rng.randn(200, 60))
+        v, _ = np.linalg.qr(rng.randn(80, 60))
+        self.singular_values = np.logspace(0, -4, 60)
+        self.matrix = (u * self.singular_values).dot(v.T)
+
+    def test_fixed_rank(self):
+        p, q = factorize(self.matrix, rank=10, seed=0)
+        self.assertEqual((p.shape, q.shape), ((200, 10), (10, 80)))
+        error = np.linalg.norm(self.matrix - p.dot(q))
+        np.testing.assert_allclose(error, np.linalg.norm(self.singular_values[10:]), rtol=1e-3)
+        truncated = LowRankApproximation(rank=10).minimize(self.matrix)
+        np.testing.assert_allclose(np.linalg.norm(self.matrix - truncated), error, rtol=1e-3)
+
+    def test_energy(self):
+        energy = 0.999
+        p, q = factorize(self.matrix, energy=energy, initial_rank=4, seed=0)
+        captured = np.cumsum(self.singular_values ** 2) / np.sum(self.singular_values ** 2)
+        self.assertEqual(p.shape[1], np.searchsorted(captured, energy) + 1)
+
+    def test_flops(self):
+        self.assertEqual(dense_flops(200, 80), 32000)
+        self.assertEqual(dense_flops(200, 80, rank=10), 5600)
+        self.assertTrue(is_worth_factorizing(200, 80, 56))
+        self.assertFalse(is_worth_factorizing(200, 80, 58))
+
+
+if __name__ == '__main__':
+    unittest.main()
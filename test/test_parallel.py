@@ -0,0 +1,55 @@
+import unittest
+
+import numpy as np
+
+from odin.compute import parallel
+from odin.compute.architecture import compute_index_set
+
+
+class ConvWrapper(object):
+    model_type = "keras"
+
+    def __init__(self):
+        self.dataset = ((np.random.standard_normal((330, 4, 4, 2)), None), (None, None))
+
+    def get_layer_outputs(self, x):
+        return [np.tanh(x), np.tanh(x).reshape(len(x), -1)]
+
+
+class TestParallel(unittest.TestCase):
+
+    def test_sharded_accumulation_matches_serial(self):
+        parallel._worker_model = ConvWrapper()
+        indices = np.arange(330)
+        batches = [indices[start:start + 100] for start in range(0, 330, 100)]
+
+        for options in [dict(streaming=False, reduction="channel"), dict(streaming=True, reduction="flatten")]:
+            serial = parallel._accumulate_shard((batches, True, options))
+            shards = [parallel._accumulate_shard((batches[:1], True, options)),
+                      parallel._accumulate_shard((batches[1:], True, options))]
+
+            expected = parallel.merge_shard_results([serial], **options)
+            merged = parallel.merge_shard_results(shards, **options)
+            for accumulator, other in zip(merged, expected):
+                self.assertEqual(accumulator.num_batches, other.num_batches)
+                np.testing.assert_allclose(accumulator.covariance(), other.covariance())
+                np.testing.assert_allclose(accumulator.mean, other.mean)
+
+    def test_workers_load_the_model_by_its_key(self):
+        model_wrapper = ConvWrapper()
+        model_wrapper.model_name = "pix2pix_dcgan"
+        model_wrapper.args = {"model": "pix2pix", "prefix": "default", "callbacks": []}
+        self.assertEqual(parallel.model_key(model_wrapper), "pix2pix")
+        self.assertEqual(parallel.model_arguments(model_wrapper), {"model": "pix2pix", "prefix": "default"})
+
+    def test_index_set_pool_is_reused_across_layers(self):
+        covs = []
+        for d in [30, 20]:
+            x = np.random.standard_normal((100, d))
+            covs.append(x.T.dot(x) / 100)
+
+        with parallel.IndexSetPool(num_workers=2) as pool:
+            for cov in covs:
+                j = compute_index_set(0, cov, 5, cov.shape[0], None, method="greedy", pool=pool)
+                expected = compute_index_set(0, cov, 5, cov.shape[0], None, method="greedy")
+                np.testing.assert_array_equal(j, expected)
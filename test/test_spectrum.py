@@ -0,0 +1,35 @@
+import unittest
+
+import numpy as np
+
+from odin.compute.spectrum import compress_spectrum, eigen_values, spectral_dof
+
+
+class TestSpectrum(unittest.TestCase):
+
+    def setUp(self):
+        x = np.random.standard_normal((500, 300)) * np.exp(-np.arange(300) / 10.0)
+        self.cov = x.T.dot(x) / 500
+
+    def test_symmetric_matches_general(self):
+        expected = np.sort(np.abs(eigen_values(self.cov, method="eigvals")))[::-1]
+        np.testing.assert_allclose(eigen_values(self.cov, method="eigvalsh"), expected, atol=1e-8)
+
+    def test_top_k_captures_trace_fraction(self):
+        full = eigen_values(self.cov, method="eigvalsh")
+        for method in ["lanczos", "randomized"]:
+            eigs = eigen_values(self.cov, method=method, trace_fraction=0.95)
+            self.assertLess(len(eigs), len(full))
+            self.assertGreaterEqual(np.sum(eigs), 0.95 * np.trace(self.cov) * (1 - 1e-6))
+            np.testing.assert_allclose(eigs, full[:len(eigs)], rtol=1e-4)
+
+    def test_compressed_spectrum(self):
+        eigs = np.random.exponential(size=20000) ** 3
+        values, weights = compress_spectrum(eigs, tol=0.05, num_exact=16)
+        self.assertLess(len(values), len(eigs) // 4)
+        self.assertEqual(np.sum(weights), len(eigs))
+        np.testing.assert_allclose(values[:16], np.sort(eigs)[::-1][:16])
+
+        lambdas = np.logspace(-6, 3, 200)
+        exact = spectral_dof(eigs, np.ones(len(eigs)), lambdas)
+        np.testing.assert_allclose(spectral_dof(values, weights, lambdas), exact, atol=0.05)